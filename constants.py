@@ -3,6 +3,7 @@ ENSIME_NOTES_VIEW = "Ensime notes"
 ENSIME_OUTPUT_VIEW = "Ensime output"
 ENSIME_STACK_VIEW = "Ensime stack"
 ENSIME_WATCHES_VIEW = "Ensime watches"
+ENSIME_METRICS_VIEW = "Ensime metrics"
 
 # region names
 ENSIME_ERROR_OUTLINE_REGION = "ensime-error"
@@ -4,11 +4,11 @@ from sublime import *
 from sublime_plugin import *
 import os, threading, thread, socket, getpass, signal, glob, errno
 import subprocess, tempfile, datetime, time, json, zipfile
-import functools, inspect, traceback, random, re, sys
+import functools, inspect, traceback, random, re, sys, Queue
 from functools import partial as bind
 from string import strip
 from types import *
-import env, dotensime, dotsession, rpc, sexp
+import env, dotensime, dotsession, rpc, sexp, ioloop, logger, metrics, ui
 from os import path
 from paths import *
 from sexp import key, sym
@@ -50,41 +50,20 @@ class EnsimeCommon(object):
         return self.env.rpc
 
     def status_message(self, msg):
-        sublime.set_timeout(bind(sublime.status_message, msg), 0)
+        # only the latest status message would be seen anyway
+        ui.call_once("status_message", sublime.status_message, msg)
 
     def error_message(self, msg):
-        sublime.set_timeout(bind(sublime.error_message, msg), 0)
+        ui.call(sublime.error_message, msg)
 
-    def log(self, data):
-        sublime.set_timeout(bind(self.log_on_ui_thread, "ui", data), 0)
+    def log(self, data, *args, **kwargs):
+        logger.instance().log("ui", data, args, kwargs.get("level", logger.INFO))
 
-    def log_client(self, data):
-        sublime.set_timeout(bind(self.log_on_ui_thread, "client", data), 0)
+    def log_client(self, data, *args, **kwargs):
+        logger.instance().log("client", data, args, kwargs.get("level", logger.INFO))
 
-    def log_server(self, data):
-        sublime.set_timeout(bind(self.log_on_ui_thread, "server", data), 0)
-
-    def log_on_ui_thread(self, flavor, data):
-        if flavor in self.env.settings.get("log_to_console", {}):
-            print(data.strip())
-        if flavor in self.env.settings.get("log_to_file", {}):
-            try:
-                if not os.path.exists(self.env.log_root):
-                    os.mkdir(self.env.log_root)
-                file_name = self.env.log_root + os.sep + flavor + ".log"
-                with open(file_name, "a") as f:
-                    f.write(self.prepare_log_message(data))
-            except:
-                exc_type, exc_value, exc_tb = sys.exc_info()
-                detailed_info = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
-                print(detailed_info)
-
-    def prepare_log_message(self, data):
-        stripped_data = data.strip()
-        buffer = "[" + unicode(datetime.datetime.now()) + "]: "
-        buffer += stripped_data
-        buffer += "\n"
-        return buffer.encode('utf-8')
+    def log_server(self, data, *args, **kwargs):
+        logger.instance().log("server", data, args, kwargs.get("level", logger.INFO))
 
     def is_valid(self):
         return bool(self.env and self.env.valid)
@@ -401,21 +380,55 @@ class EnsimeToolView(EnsimeCommon):
 
 # ############################# LOW-LEVEL: CLIENT & SERVER ##############################
 
+# payloads of these messages are plain plists, so the reader turns them into dicts right away
+# replies aren't listed here, because some of them are positional (e.g. completion signatures)
+PLIST_MESSAGES = frozenset([key(":scala-notes"), key(":java-notes"), key(":debug-event")])
+_RETURN = key(":return")
+
+
+def defer_payload(stack):
+    """Tells the decoder to only scan over the payload of a message, leaving it unparsed
+    until a handler asks for it: (:scala-notes <payload>) or (:return (:ok <payload>) msg-id).
+    The envelope itself is always parsed, so that messages can be dispatched."""
+    envelope = stack[0]
+    if not envelope:
+        return False
+    if envelope[0] is key(":return"):
+        return len(stack) == 2 and stack[1] == [key(":ok")]
+    return len(stack) == 1
+
+
+try:
+    _has_memoryview = bool(memoryview)
+except NameError:  # Python 2.6
+    _has_memoryview = False
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
 class ClientListener:
     def on_client_async_data(self, data):
         pass
 
 
 class ClientSocket(EnsimeCommon):
-    def __init__(self, owner, port, timeout, handlers):
+    def __init__(self, owner, port, timeout, handlers, metrics):
         super(ClientSocket, self).__init__(owner)
         self.port = port
         self.timeout = timeout
         self.connected = False
         self.handlers = handlers
+        self.metrics = metrics
         self._lock = threading.RLock()
         self._connect_lock = threading.RLock()
-        self._receiver = None
+        # the socket is served by the shared I/O loop: whoever issues a request
+        # (often the UI thread) only queues a frame, and the loop writes it when the socket is ready
+        self._loop = ioloop.instance()
+        self._outbox = Queue.Queue(self.env.settings.get("send_queue_size", 256) if self.env else 256)
+        self._pending = None
+        self._written = 0
+        self._drained = threading.Event()
+        self._drained.set()
         self.socket = None
 
     def notify_async_data(self, data):
@@ -423,45 +436,125 @@ class ClientSocket(EnsimeCommon):
             if handler:
                 handler.on_client_async_data(data)
 
-    def receive_loop(self):
-        while self.connected:
-            try:
-                msglen = self.socket.recv(6)
-                if msglen:
-                    msglen = int(msglen, 16)
-
-                    buf = self.socket.recv(msglen)
-                    while len(buf) < msglen:
-                        chunk = self.socket.recv(msglen - len(buf))
-                        if chunk:
-                            buf += chunk
-                        else:
-                            raise Exception("fatal error: recv returned None")
-                    self.log_client(u"RECV: " + buf.decode('utf-8'))
+    def _reset_receiver(self):
+        # all reads land in one buffer, and message bodies are decoded straight out of it,
+        # so nothing but a header split between two reads is ever carried over
+        self._buf = bytearray(2 ** 16)
+        self._view = memoryview(self._buf) if _has_memoryview else self._buf  # slicing a bytearray copies, but Python 2.6 has nothing better
+        self._header = b""
+        self._decoder = None
+        self._remaining = 0
+        self._forms = []
+        self._decode_time = 0.0
+
+    def on_readable(self):
+        try:
+            self._receive()
+        except Exception:
+            self._disconnected("Ensime server has disconnected")
 
+    def _receive(self):
+        buf, view = self._buf, self._view
+        try:
+            n = self.socket.recv_into(buf)
+        except socket.error as e:
+            if e.args[0] in _WOULD_BLOCK:
+                return
+            raise
+        if not n:
+            raise Exception("fatal error: recv returned None")
+        self.metrics.record_received(n)
+        # several messages that arrive in one read are all handled before the next read
+        pos = 0
+        while pos < n:
+            if self._decoder is None:
+                taken = min(6 - len(self._header), n - pos)
+                self._header += bytes(buf[pos:pos + taken])
+                pos += taken
+                if len(self._header) < 6:
+                    break  # the rest of the header comes with the next read
+                self._remaining = int(self._header, 16)
+                self._header = b""
+                self.log_client("RECV: %s bytes", self._remaining, level=logger.DEBUG)
+                self._decoder = sexp.Decoder(plists=PLIST_MESSAGES, defer=defer_payload)
+            size = min(self._remaining, n - pos)
+            start = time.time()
+            try:
+                self._forms.extend(self._decoder.feed(view[pos:pos + size]))
+            except:
+                self.log_client("failed to parse incoming message")
+                raise
+            self._decode_time += time.time() - start
+            pos += size
+            self._remaining -= size
+            if not self._remaining:
+                forms, self._decoder, self._forms = self._forms, None, []
+                self.metrics.record_received(0, len(forms))
+                if forms and forms[0]:
+                    self.metrics.record_parse(str(forms[0][0]), self._decode_time)
+                self._decode_time = 0.0
+                for form in forms:
+                    self.notify_async_data(form)
+        if n == len(buf) and len(buf) < 2 ** 20:
+            # big replies are coming, so read them in bigger chunks
+            self._buf = bytearray(2 * len(buf))
+            self._view = memoryview(self._buf) if _has_memoryview else self._buf
+
+    def on_writable(self):
+        try:
+            while True:
+                if self._pending is None:
+                    # whatever has piled up since the last write goes out in a single write
+                    frames = []
+                    size = 0
+                    self._lock.acquire()
                     try:
-                        s = buf.decode('utf-8')
-                        form = sexp.read(s)
-                        self.notify_async_data(form)
-                    except:
-                        self.log_client("failed to parse incoming message")
-                        raise
+                        while size < 2 ** 16:
+                            try:
+                                frame = self._outbox.get_nowait()
+                            except Queue.Empty:
+                                break
+                            frames.append(frame)
+                            size += len(frame)
+                        if not frames:
+                            self._loop.remove_writer(self.socket)
+                            self._drained.set()
+                            return
+                    finally:
+                        self._lock.release()
+                    self._pending = b"".join(frames)
+                    self._pending_frames = len(frames)
+                    self._written = 0
+                if self._written:
+                    chunk = memoryview(self._pending)[self._written:] if _has_memoryview else self._pending[self._written:]
                 else:
-                    raise Exception("fatal error: recv returned None")
-            except Exception:
-                self.log_client("*****    ERROR     *****")
-                self.log_client(traceback.format_exc())
-                self.connected = False
-                self.status_message("Ensime server has disconnected")
-                # todo. do we need to check session_ids somewhere else as well?
-                if self.env.session_id == self.session_id:
-                    self.env.controller.shutdown()
-
-    def start_receiving(self):
-        t = threading.Thread(name="ensime-client-" + str(self.w.id()) + "-" + str(self.port), target=self.receive_loop)
-        t.setDaemon(True)
-        t.start()
-        self._receiver = t
+                    chunk = self._pending
+                try:
+                    self._written += self.socket.send(chunk)
+                except socket.error as e:
+                    if e.args[0] in _WOULD_BLOCK:
+                        return
+                    raise
+                if self._written < len(self._pending):
+                    return  # the rest goes out when the socket is ready again
+                self.log_client("SENT: %s bytes in %s frame(s)", self._written, self._pending_frames, level=logger.DEBUG)
+                self._pending = None
+        except Exception as e:
+            self._disconnected("Cannot send to Ensime server: " + str(e))
+
+    def _disconnected(self, reason):
+        if not self.connected:
+            return  # we're being closed, nothing to report
+        self.log_client("*****    ERROR     *****")
+        self.log_client(traceback.format_exc())
+        self.connected = False
+        self._loop.remove_reader(self.socket)
+        self._loop.remove_writer(self.socket)
+        self._drained.set()
+        self.status_message(reason)
+        # todo. do we need to check session_ids somewhere else as well?
+        if self.env.session_id == self.session_id:
+            self.env.controller.shutdown()
 
     def connect(self):
         self._connect_lock.acquire()
@@ -469,10 +562,11 @@ class ClientSocket(EnsimeCommon):
             s = socket.socket()
             s.settimeout(self.timeout)
             s.connect(("127.0.0.1", self.port))
-            s.settimeout(None)
+            s.setblocking(0)
             self.socket = s
             self.connected = True
-            self.start_receiving()
+            self._reset_receiver()
+            self._loop.add_reader(s, self.on_readable)
             return s
         except socket.error as e:
             self.connected = False
@@ -482,18 +576,40 @@ class ClientSocket(EnsimeCommon):
         finally:
             self._connect_lock.release()
 
-    def send(self, request):
+    def send(self, frame, block=True):
+        """Queues a frame for the I/O loop. Returns False if the frame couldn't be queued,
+        either because we're not connected or because the queue has stayed full for too long."""
+        if not self.connected and not self.connect():
+            return False
         try:
-            if not self.connected:
-                self.connect()
-            self.socket.send(request)
-        except:
-            self.connected = False
+            self._outbox.put(frame, block, self.timeout)
+        except Queue.Full:
+            self.log_client("send queue is full (" + str(self._outbox.qsize()) + " frames), dropping " +
+                            str(len(frame)) + " bytes")
+            self.status_message("Ensime server isn't keeping up with requests")
+            return False
+        self._lock.acquire()
+        try:
+            self._drained.clear()
+            self._loop.add_writer(self.socket, self.on_writable)
+        finally:
+            self._lock.release()
+        return True
 
     def close(self):
         self._connect_lock.acquire()
         try:
             if self.socket:
+                if self.connected and not self._loop.in_loop_thread():
+                    # let the loop flush what's already queued (e.g. the shutdown request)
+                    self._drained.wait(self.timeout)
+                self.connected = False
+                self._loop.remove_reader(self.socket)
+                self._loop.remove_writer(self.socket)
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
                 self.socket.close()
         finally:
             self.connected = False
@@ -506,63 +622,188 @@ class Client(ClientListener, EnsimeCommon):
         with open(port_file) as f: self.port = int(f.read())
         self.timeout = timeout
         self.init_counters()
-        methods = filter(lambda m: m[0].startswith("message_"), inspect.getmembers(self, predicate=inspect.ismethod))
-        self.log_client("reflectively found " + str(len(methods)) + " message handlers: " + str(methods))
-        self.handlers = dict((":" + m[0][len("message_"):].replace("_", "-"), (m[1], None, None)) for m in methods)
+        # incoming messages are dispatched on their (interned) keyword to handlers bound right here,
+        # while replies to our requests are matched with the continuations of those requests by message id
+        self.handlers = self._bind_handlers()
+        self.continuations = {}  # msg id -> (future, deadline, time sent, swank method)
+        self.unknown_messages = {}  # keyword -> count
+        self.log_client("found %s message handlers: %s", len(self.handlers), list(self.handlers), level=logger.DEBUG)
+        # background requests (e.g. typechecks) only get a few slots on the wire,
+        # the rest wait here, so that they can't hold up interactive requests (e.g. completions)
+        self._background_queue = []
+        self._background_outstanding = 0
+        self._background_lock = threading.Lock()
+        self.max_background_requests = 2
+        # requests whose replies never come are expired by a periodic sweep
+        self.timed_out_count = 0
+        self.leaked_count = 0
+        self.request_deadline = 60
+        self.sweep_interval = 5
+        self.metrics = metrics.Registry()
+
+    _message_names = None  # [(keyword, name of the handler method)], computed once for all clients
+
+    def _bind_handlers(self):
+        cls = type(self)
+        if cls._message_names is None:
+            # e.g. message_scala_notes handles :scala-notes
+            cls._message_names = [(key(":" + name[len("message_"):].replace("_", "-")), name)
+                                  for name in dir(cls) if name.startswith("message_")]
+        return dict((message, getattr(self, name)) for message, name in cls._message_names)
 
     def startup(self):
         self.log_client(
             "Starting Ensime client (plugin version is " + (self.env.settings.get("plugin_version") or "unknown") + ")")
         self.log_client("Launching Ensime client socket at port " + str(self.port))
-        self.socket = ClientSocket(self.owner, self.port, self.timeout, [self, self.env.controller])
+        # settings can only be read on the UI thread, but requests are sent and swept from the I/O thread as well
+        self.request_deadline = self.env.settings.get("request_deadline", 60)
+        self.sweep_interval = self.env.settings.get("sweep_interval", 5)
+        self.max_background_requests = self.env.settings.get("max_background_requests", 2)
+        self.socket = ClientSocket(self.owner, self.port, self.timeout, [self, self.env.controller], self.metrics)
+        self._schedule_sweep()
         return self.socket.connect()
 
     def shutdown(self):
         print("shutdown() called")
         if self.socket.connected:
-            self.rpc.shutdown_server()
+            self.rpc.shutdown_server().result()
         self.socket.close()
         self.socket = None
+        # the replies won't come anymore, and whoever waits for them (callbacks, `then` chains) should hear about it
+        self._background_lock.acquire()
+        try:
+            queued, self._background_queue = self._background_queue, []
+        finally:
+            self._background_lock.release()
+        for _, future, _ in queued:
+            future.set_failed()
+        for msg_id, (future, _, _, _) in list(self.continuations.items()):
+            if self.continuations.pop(msg_id, None):
+                future.set_failed()
+
+    def request(self, to_send, parser=None, timeout=None, background=False, deadline=None):
+        """Sends a request without waiting for the reply, and returns the `RpcFuture` of the reply.
+        Interactive requests go out right away, while background ones are held back while
+        "max_background_requests" of them are already waiting for replies.
+        If the reply doesn't arrive within `deadline` seconds of sending (by default, "request_deadline"),
+        the request is given up on and its future fails."""
+        if not background:
+            return self.batch_request([(to_send, parser)], timeout, deadline)[0]
+
+        future = RpcFuture(parser, timeout or self.timeout)
+        self._background_lock.acquire()
+        try:
+            send_now = self._background_outstanding < self.max_background_requests
+            if send_now:
+                self._background_outstanding += 1
+            else:
+                self._background_queue.append((to_send, future, deadline))
+                future.on_cancel = bind(self._unqueue_background, future)
+        finally:
+            self._background_lock.release()
+        if send_now:
+            self._send_background(to_send, future, deadline)
+        else:
+            self.log_client("background request queued, " + str(len(self._background_queue)) + " waiting")
+        return future
+
+    def _send_background(self, to_send, future, deadline):
+        self._send([(to_send, future)], deadline)
+        # the slot is released once the request is done, whatever the outcome (even if it couldn't be sent)
+        future.add_done_hook(lambda _: self._background_done())
+
+    def _background_done(self):
+        # this usually runs on the I/O thread, which mustn't block on reconnecting,
+        # so if the connection is gone, the requests that are still waiting fail instead
+        abandoned = []
+        self._background_lock.acquire()
+        try:
+            if not self.socket or not self.socket.connected:
+                abandoned, self._background_queue = self._background_queue, []
+            if not self._background_queue:
+                self._background_outstanding -= 1
+                waiting = None
+            else:
+                waiting = self._background_queue.pop(0)
+        finally:
+            self._background_lock.release()
+        for _, future, _ in abandoned:
+            future.set_failed()
+        if waiting:
+            self._send_background(*waiting)
+
+    def _unqueue_background(self, future):
+        self._background_lock.acquire()
+        try:
+            self._background_queue = [entry for entry in self._background_queue if entry[1] is not future]
+        finally:
+            self._background_lock.release()
+
+    def batch_request(self, requests, timeout=None, deadline=None):
+        """Sends several (request, parser) pairs back-to-back in a single write, and returns their futures."""
+        futures = [RpcFuture(parser, timeout or self.timeout) for _, parser in requests]
+        self._send(zip([to_send for to_send, _ in requests], futures), deadline)
+        return futures
 
-    def async_req(self, to_send, on_complete=None, call_back_into_ui_thread=None):
-        if on_complete is not None and call_back_into_ui_thread is None:
-            raise Exception("must specify a threading policy when providing a non-empty callback")
+    def _send(self, requests, deadline=None):
         if not self.socket:
             raise Exception("socket is either not yet initialized or is already destroyed")
 
-        msg_id = self.next_message_id()
-        self.handlers[msg_id] = (on_complete, call_back_into_ui_thread, time.time())
-        msg_str = sexp.to_string([key(":swank-rpc"), to_send, msg_id])
-        msg_str = "%06x" % len(msg_str) + msg_str
-
-        self.feedback(msg_str)
-        self.log_client("async_req: " + str(msg_id) + "  " + msg_str)
-        self.socket.send(encode_if_unicode(msg_str))
-
-    def sync_req(self, to_send, timeout=0):
-        msg_id = self.next_message_id()
-        event = threading.Event()
-        self.handlers[msg_id] = (event, None, time.time())
-        msg_str = sexp.to_string([key(":swank-rpc"), to_send, msg_id])
-        msg_str = "%06x" % len(msg_str) + msg_str
-
-        self.feedback(msg_str)
-        self.log_client("SEND SYNC REQ: " + msg_str)
-        self.socket.send(msg_str)
-
-        max_wait = timeout or self.timeout
-        event.wait(max_wait)
-        if hasattr(event, "payload"):
-            return event.payload
-        else:
-            self.log_client("sync_req #" + str(msg_id) +
-                            " has timed out (didn't get a response after " +
-                            str(max_wait) + " seconds)")
-            return None
+        now = time.time()
+        expires = now + (deadline or self.request_deadline)
+        frames = []
+        msg_ids = []
+        for to_send, future in requests:
+            msg_id = self.next_message_id()
+            msg_ids.append(msg_id)
+            method = str(to_send[0])
+            if future.parser:
+                future.parser = self.metrics.timed(method, future.parser)
+            # a cancelled request doesn't need a handler anymore, and its reply gets dropped
+            future.on_cancel = bind(self.continuations.pop, msg_id, None)
+            self.continuations[msg_id] = (future, expires, now, method)
+            frames.append(sexp.to_frame([key(":swank-rpc"), to_send, msg_id]))
+        if not frames:
+            return
+        data = b"".join(frames)
+        self.metrics.record_sent(len(data), len(frames))
+        self.log_client("SEND: %s", data, level=logger.DEBUG)
+        if not self.socket.send(data, block=False):
+            # the requests have failed rather than been given up on, so that their callers hear about it
+            for msg_id, (_, future) in zip(msg_ids, requests):
+                self.continuations.pop(msg_id, None)
+                future.set_failed()
+
+    def _schedule_sweep(self):
+        ioloop.instance().call_later(self.sweep_interval, self._sweep)
+
+    def _sweep(self):
+        """Expires the requests that are past their deadline, failing their futures,
+        and drops the continuations of requests that have been resolved without their replies."""
+        if not self.socket:
+            return  # the client has been shut down, and so has the sweep
+        now = time.time()
+        timed_out = 0
+        leaked = 0
+        for msg_id, (future, expires, _, _) in list(self.continuations.items()):
+            if future.done():
+                leaked += 1
+            elif expires < now:
+                timed_out += 1
+            else:
+                continue
+            if self.continuations.pop(msg_id, None):
+                future.set_failed()
+        if timed_out or leaked:
+            self.timed_out_count += timed_out
+            self.leaked_count += leaked
+            self.log_client("sweep: " + str(timed_out) + " requests timed out (" + str(self.timed_out_count) +
+                            " in total), " + str(leaked) + " leaked entries dropped (" + str(self.leaked_count) +
+                            " in total), " + str(len(self.continuations)) + " requests pending")
+        self._schedule_sweep()
 
     def on_client_async_data(self, data):
-        self.log_client("on_client_async_data: " + str(data))
-        self.feedback(str(data))
+        self.log_client("RECV: %s", data, level=logger.DEBUG)
         self.handle_message(data)
 
     # examples of responses can be seen here:
@@ -572,79 +813,64 @@ class Client(ClientListener, EnsimeCommon):
         # (:background-message "Initializing Analyzer. Please wait...")
         # (:compiler-ready t)
         # (:typecheck-result (:lang :scala :is-full t :notes nil))
-        msg_type = str(data[0])
+        msg_type = data[0]
         handler = self.handlers.get(msg_type)
-        if handler:
-            self.log_client("handleMessage: got handler" + str(handler))
-            handler, _, _ = handler
-            msg_id = data[-1] if msg_type == ":return" else None
-            data = data[1:-1] if msg_type == ":return" else data[1:]
-            payload = None
-            if len(data) == 1: payload = data[0]
-            if len(data) > 1: payload = data
-            self.log_client("handleMessage: got handler2")
-            self.log_client("XXX Got msg_id " + str(msg_id) + "  payload " + str(payload))
-            return handler(msg_id, payload)
+        if handler is None:
+            self.unknown_messages[msg_type] = self.unknown_messages.get(msg_type, 0) + 1
+            self.log_client("handle_message: unexpected message type: %s", msg_type)
+        elif msg_type is _RETURN:
+            return handler(data[-1], data[1])
+        elif len(data) == 2:
+            return handler(None, data[1])
         else:
-            self.log_client("handle_message: unexpected message type: " + msg_type)
+            return handler(None, data[1:] if len(data) > 2 else None)
 
     def message_return(self, msg_id, payload):
-        handler, call_back_into_ui_thread, req_time = self.handlers.get(msg_id)
-        if handler: del self.handlers[msg_id]
-
-        def invoke_subscribed_handler(success, payload=None):
-            if callable(handler):
-                # only do async callbacks if the result is a success
-                # however note that we need to ping sync callbacks in any case
-                # in order to prevent freezes upon erroneous responses
-                if call_back_into_ui_thread and success:
-                    sublime.set_timeout(bind(handler, payload), 0)
-                else:
-                    handler(payload)
-            else:
-                handler.payload = payload
-                handler.set()
+        entry = self.continuations.pop(msg_id, None)
+        if not entry:
+            # the request has been abandoned, so its payload is dropped without being parsed
+            self.log_client("warning: dropping reply to abandoned message #" + str(msg_id))
+            return
+        future, _, req_time, method = entry
 
         resp_time = time.time()
-        self.log_client("request #" + str(msg_id) + " took " + str(resp_time - req_time) + " seconds")
+        self.log_client("request #%s took %s seconds", msg_id, resp_time - req_time, level=logger.DEBUG)
+        self.metrics.record_latency(method, resp_time - req_time)
 
         reply_type = str(payload[0])
         # (:return (:ok (:project-name nil :source-roots ("D:\\Dropbox\\Scratchpad\\Scala"))) 2)
         if reply_type == ":ok":
-            payload = payload[1]
-            if handler:
-                invoke_subscribed_handler(success=True, payload=payload)
-            else:
-                self.log_client(
-                    "warning: no handler registered for message #" + str(msg_id) + " with payload " + str(payload))
+            future.set_payload(payload[1])
         # (:return (:abort 210 "Error occurred in Analyzer. Check the server log.") 3)
         elif reply_type == ":abort":
             detail = payload[2]
+            future.set_failed()
             if msg_id <= 1:  # initialize project
                 self.error_message(self.prettify_error_detail(detail))
                 self.status_message("Ensime startup has failed")
-                self.env.controller.shutdown()
+                # this runs on the I/O thread, which the shutdown would block while it waits for the server
+                ui.call(self.env.controller.shutdown)
             else:
-                invoke_subscribed_handler(success=False)
                 self.status_message(detail)
         # (:return (:error NNN "SSS") 4)
         elif reply_type == ":error":
             detail = payload[2]
-            invoke_subscribed_handler(success=False)
+            future.set_failed()
             self.error_message(self.prettify_error_detail(detail))
         else:
-            invoke_subscribed_handler(success=False)
+            future.set_failed()
             self.log_client("unexpected reply type: " + reply_type)
 
     def call_back_into_ui_thread(vanilla):
         def wrapped(self, msg_id, payload):
-            sublime.set_timeout(bind(vanilla, self, msg_id, payload), 0)
+            ui.call(vanilla, self, msg_id, payload)
 
         return wrapped
 
     @call_back_into_ui_thread
     def message_compiler_ready(self, msg_id, payload):
         self.env.compiler_ready = True
+        self._invalidate_rpc_cache()
         filename = self.env.plugin_root + os.sep + "Encouragements.txt"
         lines = [line.strip() for line in open(filename)]
         msg = lines[random.randint(0, len(lines) - 1)]
@@ -667,7 +893,18 @@ class Client(ClientListener, EnsimeCommon):
         # (:background-message 105 "Initializing Analyzer. Please wait...")
         self.status_message(payload[1])
 
+    def _invalidate_rpc_cache(self):
+        # the compiler has learned something new, so the answers it gave before might be outdated
+        cache = self.env.rpc_cache
+        self.log_client("clearing the response cache (" + str(len(cache)) + " entries, " + str(cache.hits) +
+                        " hits, " + str(cache.misses) + " misses so far)")
+        cache.clear()
+
     def _update_note_ui(self):
+        # a burst of notes messages only redraws once
+        ui.call_once(("update_note_ui", self.w.id()), self._redraw_note_ui)
+
+    def _redraw_note_ui(self):
         self.redraw_all_highlights()
         v = self.w.active_view()
         if v != None:
@@ -681,6 +918,7 @@ class Client(ClientListener, EnsimeCommon):
 
     @call_back_into_ui_thread
     def message_scala_notes(self, msg_id, payload):
+        self._invalidate_rpc_cache()
         self.env._notes.append(rpc.Note.parse_list(payload))
         self._update_note_ui()
 
@@ -719,10 +957,6 @@ class Client(ClientListener, EnsimeCommon):
         detail += "\n\nCheck the server log at " + self.env.log_root + os.sep + "server.log" + "."
         return detail
 
-    def feedback(self, msg):
-        msg = msg.replace("\r\n", "\n").replace("\r", "\n") + "\n"
-        self.log_client(msg)
-
 
 class ServerListener:
     def on_server_data(self, data):
@@ -762,11 +996,12 @@ class ServerProcess(EnsimeCommon):
                 cwd=self.env.server_path)
         self.log_server("started ensime server with pid " + str(self.proc.pid))
 
-        if self.proc.stdout:
-            thread.start_new_thread(self.read_stdout, ())
-
-        if self.proc.stderr:
-            thread.start_new_thread(self.read_stderr, ())
+        for pipe in [self.proc.stdout, self.proc.stderr]:
+            if pipe:
+                if ioloop.can_select(pipe):
+                    ioloop.instance().add_reader(pipe, bind(self.read_pipe, pipe))
+                else:
+                    thread.start_new_thread(self.read_pipe_until_closed, (pipe,))
 
     def kill(self):
         if not self.killed:
@@ -777,27 +1012,21 @@ class ServerProcess(EnsimeCommon):
     def poll(self):
         return self.proc.poll() == None
 
-    def read_stdout(self):
-        while True:
-            data = os.read(self.proc.stdout.fileno(), 2 ** 15)
-            if data != "":
-                for listener in self.listeners:
-                    if listener:
-                        listener.on_server_data(data)
-            else:
-                self.proc.stdout.close()
-                break
-
-    def read_stderr(self):
-        while True:
-            data = os.read(self.proc.stderr.fileno(), 2 ** 15)
-            if data != "":
-                for listener in self.listeners:
-                    if listener:
-                        listener.on_server_data(data)
-            else:
-                self.proc.stderr.close()
-                break
+    def read_pipe(self, pipe):
+        data = os.read(pipe.fileno(), 2 ** 15)
+        if data != "":
+            for listener in self.listeners:
+                if listener:
+                    listener.on_server_data(data)
+            return True
+        else:
+            ioloop.instance().remove_reader(pipe)
+            pipe.close()
+            return False
+
+    def read_pipe_until_closed(self, pipe):
+        while self.read_pipe(pipe):
+            pass
 
 
 class Server(ServerListener, EnsimeCommon):
@@ -1039,7 +1268,7 @@ class Colorer(EnsimeCommon):
             self._update_statusbar(None)
 
     def _update_statusbar(self, status):
-        sublime.set_timeout(bind(self._update_statusbar_callback, status), 100)
+        ui.call_once(("update_statusbar", self.v.id()), self._update_statusbar_callback, status, delay=100)
 
     def _update_statusbar_callback(self, status):
         settings = self.env.settings if self.env else sublime.load_settings("Ensime.sublime-settings")
@@ -1200,7 +1429,7 @@ class Completer(EnsimeEventListener):
         else:
             source_file_info = SourceFileInfo(self.v.file_name())
 
-        completions = self.rpc.completions(source_file_info, locations[0], 100, False, False)
+        completions = self.rpc.completions(source_file_info, locations[0], 100, False, False, view=self.v).result()
         if not completions:
             self.env.completion_ignore_prefix = prefix
             return self._completion_response(CompletionInfoList.create(prefix, []))
@@ -1258,6 +1487,7 @@ class EnsimeShowSession(EnsimeWindowCommand):
 
 
 def _show_log(self, file_name):
+    logger.instance().flush()
     log = self.env.log_root + os.sep + file_name
     line = 1
     try:
@@ -1328,6 +1558,57 @@ class Notes(EnsimeToolView):
         return "\n".join(lines)
 
 
+class EnsimeShowMetrics(EnsimeWindowCommand):
+    def is_enabled(self):
+        return self.env.metrics.can_show()
+
+    def run(self):
+        self.env.metrics.show()
+
+
+class Metrics(EnsimeToolView):
+    def can_show(self):
+        return bool(self.is_running() and self.env.controller and self.env.controller.client)
+
+    @property
+    def name(self):
+        return ENSIME_METRICS_VIEW
+
+    def show(self):
+        super(Metrics, self).show()
+        if not self.env.metrics_refreshing:
+            self.env.metrics_refreshing = True
+            self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        sublime.set_timeout(self._refresh_while_open, self.env.settings.get("metrics_refresh_interval", 1000))
+
+    def _refresh_while_open(self):
+        if self.v is not None and self.can_show():
+            self.refresh()
+            self._schedule_refresh()
+        else:
+            self.env.metrics_refreshing = False
+
+    def render(self):
+        if not self.can_show():
+            return "Ensime is not running"
+        client = self.env.controller.client
+        in_flight = {}
+        for entry in list(client.continuations.values()):
+            in_flight[entry[3]] = in_flight.get(entry[3], 0) + 1
+        cache = self.env.rpc_cache
+        extras = [
+            ("background queue", str(len(client._background_queue)) + " requests"),
+            ("timed out", str(client.timed_out_count) + " requests"),
+            ("leaked", str(client.leaked_count) + " continuations"),
+            ("unknown messages", str(sum(client.unknown_messages.values()))),
+            ("response cache", str(len(cache)) + " entries, " + str(cache.hits) + " hits, " +
+             str(cache.misses) + " misses"),
+        ]
+        return client.metrics.render(in_flight, extras)
+
+
 class EnsimeAltClick(EnsimePreciseMouseCommand):
     def is_applicable(self):
         return self.env.settings.get("alt_click_inspects_type_at_point") and super(EnsimeAltClick, self).is_applicable()
@@ -1339,7 +1620,7 @@ class EnsimeAltClick(EnsimePreciseMouseCommand):
 class EnsimeInspectTypeAtPoint(RunningProjectFileOnly, EnsimeTextCommand):
     def run(self, edit, target=None):
         pos = int(target or self.v.sel()[0].begin())
-        self.rpc.type_at_point(self.v.file_name(), pos, self.handle_reply)
+        self.rpc.type_at_point(self.v.file_name(), pos, view=self.v).add_done_callback(self.handle_reply)
 
     def handle_reply(self, tpe):
         self.log_client("EnsimeInspectTypeAtPoint.handleReply: " + str(tpe))
@@ -1367,7 +1648,7 @@ class EnsimeCtrlClick(EnsimePreciseMouseCommand):
 class EnsimeGoToDefinition(RunningProjectFileOnly, EnsimeTextCommand):
     def run(self, edit, target=None):
         pos = int(target or self.v.sel()[0].begin())
-        self.rpc.symbol_at_point(self.v.file_name(), pos, self.handle_reply)
+        self.rpc.symbol_at_point(self.v.file_name(), pos, view=self.v).add_done_callback(self.handle_reply)
 
     def handle_reply(self, info):
         if info and info.decl_pos:
@@ -1447,9 +1728,13 @@ class EnsimeAddImport(RunningProjectFileOnly, EnsimeTextCommand):
                 self.v.run_command('save')
             self.rpc.import_suggestions(self.v.file_name(), pos, [word],
                                         self.env.settings.get("max_import_suggestions", 10),
-                                        self.handle_sugestions_response)
+                                        view=self.v).add_done_callback(
+                self.handle_sugestions_response)
 
     def handle_sugestions_response(self, info):
+        if not info:
+            self.status_message("Cannot find import suggestions")  # the request has failed or timed out
+            return
         # We only send one word in the request so there should only be one SymbolSearchResults in the response list
         results = info[0].results
         names = map(lambda a: a.name, results)
@@ -1458,11 +1743,15 @@ class EnsimeAddImport(RunningProjectFileOnly, EnsimeTextCommand):
             if (i > -1):
                 params = [sym('qualifiedName'), names[i], sym('file'), self.v.file_name(), sym('start'), 0, sym('end'),
                           0]
-                self.rpc.prepare_refactor(1, sym('addImport'), params, False, self.handle_refactor_response)
+                self.rpc.prepare_refactor(1, sym('addImport'), params, False).add_done_callback(
+                    self.handle_refactor_response)
 
         self.v.window().show_quick_panel(names, do_refactor)
 
     def handle_refactor_response(self, response):
+        if not response:
+            self.status_message("Cannot add the import")  # nothing has changed, so there's nothing to reload
+            return
         view = self.v
         original_size = view.size()
         original_pos = view.sel()[0].begin()
@@ -1505,10 +1794,10 @@ class EnsimeToggleBreakpoint(ProjectFileOnly, EnsimeTextCommand):
             if len(old_breakpoints) == len(new_breakpoints):
                 # add
                 new_breakpoints.append(dotsession.Breakpoint(file_name, line))
-                if self.env.profile: self.rpc.debug_set_break(file_name, line)
+                if self.env.profile: self.rpc.debug_set_break(file_name, line, background=True)
             else:
                 # remove
-                if self.env.profile: self.rpc.debug_clear_break(file_name, line)
+                if self.env.profile: self.rpc.debug_clear_break(file_name, line, background=True)
             self.env.breakpoints = new_breakpoints
             self.env.save_session()
             self.redraw_all_breakpoints()
@@ -1699,15 +1988,20 @@ class Debugger(EnsimeCommon):
             else:
                 focus_summary = "an unknown location"
             self.redraw_all_debug_focuses()
-            self.env.stack.update_backtrace()
+            backtrace = self.env.stack.update_backtrace()
             if event.type == "exception":
-                rendered = "an unhandled exception has been thrown: "
-                rendered += (
-                    str(self.rpc.debug_to_string(event.thread_id, DebugLocationReference(event.exception_id))) + "\n")
-                rendered += "\n".join(map(lambda line: "  " + line, self.env.stack.render().split("\n")))
-                # TODO: handle double click. it won't work for output, because it lacks a stack-like handler
-                self.env.output.append(rendered + "\n")
-                self.env.output.show()
+                exception = self.rpc.debug_to_string(event.thread_id, DebugLocationReference(event.exception_id))
+
+                def report_exception(results):
+                    rendered = "an unhandled exception has been thrown: "
+                    rendered += str(results[0]) + "\n"
+                    if self.env.backtrace:
+                        rendered += "\n".join(map(lambda line: "  " + line, self.env.stack.render().split("\n")))
+                    # TODO: handle double click. it won't work for output, because it lacks a stack-like handler
+                    self.env.output.append(rendered + "\n")
+                    self.env.output.show()
+
+                gather([exception, backtrace]).add_done_callback(report_exception)
             self.status_message("(" + str(event.type) + ") Debugger has stopped at " + str(focus_summary))
         self.redraw_status(self.w.active_view())
 
@@ -1731,10 +2025,13 @@ class Debugger(EnsimeCommon):
                                 self.type = "start"
 
                         self.handle(FakeStartEvent())
+                elif status is None:
+                    # either an earlier step has failed, or the server hasn't replied in time
+                    self.status_message("Debugger has failed to start" + launch_name)
                 else:
                     self.status_message("Debugger has failed to start" + launch_name + ". " + str(status.details))
 
-            self.rpc.debug_start(launch, self.env.breakpoints, callback)
+            self.rpc.debug_start(launch, self.env.breakpoints).add_done_callback(callback)
         else:
             self.status_message("Bad debug configuration")
 
@@ -1810,13 +2107,13 @@ class Stack(EnsimeToolView):
         self._update_v("")
 
     def update_backtrace(self):
-        # TODO: this should really be asynchronous
-        # if you implement this, make sure to change correspond method signatures in rpc.py
-        # to say "@async_rpc" instead of "@sync_rpc"
         # TODO: acquire backtraces of all running threads
-        self.env.backtrace = self.rpc.debug_backtrace(self.env.focus.thread_id)
-        self.refresh()
-        self.env.watches.update_stackframe(0)
+        def on_backtrace(backtrace):
+            self.env.backtrace = backtrace
+            self.refresh()
+            self.env.watches.update_stackframe(0)
+
+        return self.rpc.debug_backtrace(self.env.focus.thread_id).then(on_backtrace, on_ui_thread=True)
 
     def render(self):
         rendered = []
@@ -1926,7 +2223,7 @@ class WatchValueReferenceNode(WatchNode):
     def load_description(self):
         if self.value.length != 0:
             result = self.env.rpc.debug_to_string(self.env.focus.thread_id,
-                                                  DebugLocationReference(self.value.object_id))
+                                                  DebugLocationReference(self.value.object_id)).result()
             result = result if result != False and result is not None else "<failed to evaluate>"
             return result
         else:
@@ -1997,7 +2294,7 @@ class WatchValueArrayNode(WatchValueCollectionNode):
     def enumerate_elements(self):
         for i in range(self.start, self.value.length):
             key = "[" + str(i) + "]"
-            value = self.rpc.debug_value(DebugLocationElement(self.value.object_id, i))
+            value = self.rpc.debug_value(DebugLocationElement(self.value.object_id, i)).result()
             yield (key, value)
 
 
@@ -2006,10 +2303,13 @@ class WatchValueObjectNode(WatchValueReferenceNode):
         super(WatchValueObjectNode, self).__init__(env, parent, label, value)
 
     def enumerate_children(self):
+        # all fields are fetched in one round-trip
+        batch = self.rpc.batch()
         for field in self.value.fields:
-            key = field.name
-            value = self.rpc.debug_value(DebugLocationField(self.value.object_id, field.name))
-            yield (key, value)
+            batch.debug_value(DebugLocationField(self.value.object_id, field.name))
+        values = batch.wait()
+        for field, value in zip(self.value.fields, values):
+            yield (field.name, value)
 
 
 def create_watch_value_node(env, parent, label, value):
@@ -2045,16 +2345,17 @@ class WatchRoot(WatchNode):
 
     def load_children(self):
         if self.env.stackframe:
+            # TODO: this, along with other stuff in WatchValueNode, should really be asynchronous
+            # `this` and all the locals are fetched in one round-trip
+            labels = []
+            batch = self.rpc.batch()
             if self.env.stackframe.this_object_id != "-1":  # supposedly, this stands for "invalid value"
-                value = self.rpc.debug_value(DebugLocationReference(self.env.stackframe.this_object_id))
-                yield create_watch_value_node(self.env, self, "this", value)
+                labels.append("this")
+                batch.debug_value(DebugLocationReference(self.env.stackframe.this_object_id))
             for i, local in enumerate(self.env.stackframe.locals):
-                label = local.name
-                # TODO: this, along with other stuff in WatchValueNode, should really be asynchronous
-                # if you implement this, make sure to change correspond method signatures in rpc.py
-                # to say "@async_rpc" instead of "@sync_rpc"
-                value = self.rpc.debug_value(
-                    DebugLocationSlot(self.env.backtrace.thread_id, self.env.stackframe.index, i))
+                labels.append(local.name)
+                batch.debug_value(DebugLocationSlot(self.env.backtrace.thread_id, self.env.stackframe.index, i))
+            for label, value in zip(labels, batch.wait()):
                 yield create_watch_value_node(self.env, self, label, value)
 
 
@@ -1,7 +1,7 @@
 import sublime
 import threading, uuid
 from uuid import uuid4
-import dotensime, dotsession
+import dotensime, dotsession, logger
 from paths import *
 
 envLock = threading.RLock()
@@ -79,6 +79,7 @@ class EnsimeEnvironment(object):
         self.ensime_args = ""  # TODO Should be loaded from .ensime file
         self.plugin_root = os.path.normpath(os.path.join(self.server_path, ".."))
         self.log_root = os.path.normpath(os.path.join(self.plugin_root, "logs"))
+        logger.configure(self.settings, self.log_root)
 
         # instance-specific stuff (immutable)
         (root, conf, _) = dotensime.load(self.w)
@@ -138,6 +139,15 @@ class EnsimeEnvironment(object):
         # that don't exist.
         self.completion_ignore_prefix = None
 
+        # rpc stuff (mutable)
+        # lives here rather than in Rpc, because a new Rpc is created on every access to `rpc`
+        self.rpc_latest = {}  # (method name, view id) -> future of the latest request
+        self.rpc_in_flight = {}  # (view id or None, serialized request) -> future of the pending request
+        self.rpc_lock = threading.RLock()
+        from rpc import ResponseCache
+        self.rpc_cache = ResponseCache(self.settings.get("rpc_cache_size", 128))
+        self.metrics_refreshing = False
+
         # debugger stuff (mutable)
         # didn't prefix it with "debugger_", because there are no name clashes yet
         self.profile_being_launched = None
@@ -174,6 +184,12 @@ class EnsimeEnvironment(object):
 
         return Notes(self)
 
+    @property
+    def metrics(self):
+        from ensime import Metrics
+
+        return Metrics(self)
+
     @property
     def debugger(self):
         from ensime import Debugger
@@ -0,0 +1,188 @@
+import os, select, socket, threading, traceback, errno, heapq, time
+
+# one thread waits on the client sockets and server pipes of all windows at once,
+# instead of every connection parking a thread or two in a blocking read.
+# handlers run on that thread, so they must never block:
+# read and write only what select has reported as ready, and hand everything else off.
+# the loop also runs timers (e.g. housekeeping), which are bound by the same rule
+
+loopLock = threading.RLock()
+_loop = None
+
+
+def instance():
+    global _loop
+    loopLock.acquire()
+    try:
+        if not _loop:
+            _loop = IOLoop()
+        return _loop
+    finally:
+        loopLock.release()
+
+
+def can_select(fileobj):
+    """Sockets can be selected everywhere, pipes everywhere but on Windows."""
+    return os.name != "nt" or isinstance(fileobj, socket.socket)
+
+
+def _socketpair():
+    if hasattr(socket, "socketpair"):
+        return socket.socketpair()
+    # Windows: connect a pair of loopback sockets by hand
+    listener = socket.socket()
+    try:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        a = socket.socket()
+        a.connect(listener.getsockname())
+        b, _ = listener.accept()
+        return a, b
+    finally:
+        listener.close()
+
+
+class IOLoop(object):
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._readers = {}
+        self._writers = {}
+        self._waker, self._wakee = _socketpair()
+        self._waker.setblocking(0)
+        self._wakee.setblocking(0)
+        self._timers = []  # heap of (due time, sequence number, callback)
+        self._timer_seq = 0
+        self._thread = None
+
+    def add_reader(self, fileobj, callback):
+        """Calls `callback()` on the loop thread whenever `fileobj` has something to read."""
+        self._register(self._readers, fileobj, callback)
+
+    def remove_reader(self, fileobj):
+        self._unregister(self._readers, fileobj)
+
+    def add_writer(self, fileobj, callback):
+        """Calls `callback()` on the loop thread whenever `fileobj` can be written to.
+        Writers are meant to be removed as soon as they have nothing to write."""
+        self._register(self._writers, fileobj, callback)
+
+    def remove_writer(self, fileobj):
+        self._unregister(self._writers, fileobj)
+
+    def call_later(self, delay, callback):
+        """Calls `callback()` once on the loop thread, after `delay` seconds."""
+        self._lock.acquire()
+        try:
+            self._timer_seq += 1
+            heapq.heappush(self._timers, (time.time() + delay, self._timer_seq, callback))
+            self._start()
+        finally:
+            self._lock.release()
+        self._wake()
+
+    def in_loop_thread(self):
+        return threading.currentThread() is self._thread
+
+    def _register(self, handlers, fileobj, callback):
+        self._lock.acquire()
+        try:
+            handlers[fileobj] = callback
+            self._start()
+        finally:
+            self._lock.release()
+        self._wake()
+
+    def _start(self):
+        if not self._thread:
+            self._thread = threading.Thread(name="ensime-io", target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _unregister(self, handlers, fileobj):
+        self._lock.acquire()
+        try:
+            handlers.pop(fileobj, None)
+        finally:
+            self._lock.release()
+        self._wake()
+
+    def _wake(self):
+        if not self.in_loop_thread():
+            try:
+                self._waker.send(b"x")
+            except socket.error:
+                pass  # the loop is already awake, and a byte is waiting for it
+
+    def _snapshot(self):
+        self._lock.acquire()
+        try:
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.time())
+            else:
+                timeout = None
+            return dict(self._readers), dict(self._writers), timeout
+        finally:
+            self._lock.release()
+
+    def _due_timers(self):
+        now = time.time()
+        due = []
+        self._lock.acquire()
+        try:
+            while self._timers and self._timers[0][0] <= now:
+                due.append(heapq.heappop(self._timers)[2])
+        finally:
+            self._lock.release()
+        return due
+
+    def _prune(self):
+        # something has been closed without being unregistered first
+        self._lock.acquire()
+        try:
+            for handlers in [self._readers, self._writers]:
+                for fileobj in list(handlers):
+                    try:
+                        os.fstat(fileobj.fileno())
+                    except (OSError, ValueError, socket.error):
+                        del handlers[fileobj]
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            readers, writers, timeout = self._snapshot()
+            try:
+                readable, writable, _ = select.select([self._wakee] + list(readers), list(writers), [], timeout)
+            except (select.error, socket.error, ValueError) as e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                self._prune()
+                continue
+            for fileobj in writable:
+                self._dispatch(self._writers, fileobj, writers[fileobj])
+            for fileobj in readable:
+                if fileobj is self._wakee:
+                    try:
+                        while self._wakee.recv(4096):
+                            pass
+                    except socket.error:
+                        pass
+                else:
+                    self._dispatch(self._readers, fileobj, readers[fileobj])
+            for callback in self._due_timers():
+                try:
+                    callback()
+                except Exception:
+                    print("ensime-io: unhandled error in a timer")
+                    traceback.print_exc()
+
+    def _dispatch(self, handlers, fileobj, callback):
+        # a handler that has been removed in the meanwhile doesn't get called
+        if handlers.get(fileobj) != callback:
+            return
+        try:
+            callback()
+        except Exception:
+            print("ensime-io: unhandled error in a handler, dropping it")
+            traceback.print_exc()
+            self._unregister(handlers, fileobj)
@@ -0,0 +1,243 @@
+import os, sys, threading, traceback, datetime, Queue
+
+# log lines are handed to a single writer thread, so that logging never touches files on the caller's thread.
+# the writer keeps log files open, writes whatever has piled up in one go, and rotates files that grow too big.
+# settings can only be read on the UI thread, so the logger works off a snapshot taken there (see `configure`).
+# messages are formatted on the writer thread, and only if some sink wants them:
+#   self.log_client("RECV: %s", form, level=logger.DEBUG)
+# costs next to nothing unless "client" is logged at "debug" level
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+_OFF = ERROR + 1
+
+loggerLock = threading.RLock()
+_logger = None
+
+
+def instance():
+    global _logger
+    loggerLock.acquire()
+    try:
+        if not _logger:
+            _logger = Logger()
+        return _logger
+    finally:
+        loggerLock.release()
+
+
+def configure(settings, log_root):
+    """Takes a snapshot of the logging settings. Must be called on the UI thread."""
+    logger = instance()
+    logger.update(settings, log_root)
+    # "ensime-logger" replaces the callback of an earlier call, so there's only ever one
+    settings.add_on_change("ensime-logger", lambda: logger.update(settings, log_root))
+
+
+def _sinks(setting):
+    """Reads "log_to_file" and "log_to_console": either a list of flavors logged at "info" level,
+    or a dictionary of flavors to their levels, e.g. {"client": "debug", "server": "info"}."""
+    if isinstance(setting, dict):
+        return dict((flavor, LEVELS.get(str(level).lower(), INFO)) for flavor, level in setting.items())
+    return dict((flavor, INFO) for flavor in setting)
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")  # e.g. raw output of the server or frames on the wire
+    if isinstance(value, bytearray):
+        return bytes(value).decode("utf-8", "replace")
+    return unicode(value)
+
+
+class Logger(object):
+    def __init__(self):
+        self.to_console = {}
+        self.to_file = {}
+        self.preview_length = None
+        self.log_root = None
+        self._thresholds = {}
+        self.max_size = 10 * 2 ** 20
+        self.max_files = 3
+        self.dropped = 0
+        self._queue = Queue.Queue(10000)
+        self._files = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def update(self, settings, log_root):
+        self.to_console = _sinks(settings.get("log_to_console", []))
+        self.to_file = _sinks(settings.get("log_to_file", []))
+        thresholds = dict(self.to_file)
+        for flavor, level in self.to_console.items():
+            thresholds[flavor] = min(level, thresholds.get(flavor, _OFF))
+        self._thresholds = thresholds
+        self.preview_length = settings.get("log_preview_length")
+        self.max_size = settings.get("log_max_size", 10 * 2 ** 20)
+        self.max_files = settings.get("log_max_files", 3)
+        self.log_root = log_root
+
+    def enabled(self, flavor, level=INFO):
+        return level >= self._thresholds.get(flavor, _OFF)
+
+    def log(self, flavor, data, args=(), level=INFO):
+        """Queues `data % args` for the log of `flavor`, unless that log is turned off for `level`.
+        Can be called from any thread, and `args` must not change afterwards, because they are rendered later on."""
+        if not self.enabled(flavor, level):
+            return
+        self._start()
+        try:
+            self._queue.put_nowait((flavor, datetime.datetime.now(), (data, args, level)))
+        except Queue.Full:
+            self.dropped += 1  # the writer can't keep up, so lines are dropped rather than blocking the caller
+
+    def flush(self, timeout=1):
+        """Waits until everything logged so far has been written, e.g. before opening a log in the editor."""
+        if not self._thread:
+            return
+        written = threading.Event()
+        try:
+            self._queue.put((None, None, written), True, timeout)
+        except Queue.Full:
+            return
+        written.wait(timeout)
+
+    def _start(self):
+        if self._thread:
+            return
+        self._lock.acquire()
+        try:
+            if not self._thread:
+                self._thread = threading.Thread(name="ensime-log", target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < 1000:
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                self._write(batch)
+            except Exception:
+                traceback.print_exc()
+
+    def _write(self, batch):
+        lines = {}
+        flushed = [entry for flavor, _, entry in batch if flavor is None]
+        try:
+            for flavor, when, entry in batch:
+                if flavor is None:
+                    continue
+                data, args, level = entry
+                to_console = level >= self.to_console.get(flavor, _OFF)
+                to_file = level >= self.to_file.get(flavor, _OFF)
+                if not to_console and not to_file:
+                    continue  # the settings have changed in the meanwhile
+                try:
+                    stripped_data = self._render(data, args).strip()
+                except Exception:
+                    # e.g. an argument that can't be turned into text, which mustn't cost the rest of the batch
+                    error = traceback.format_exc().strip().splitlines()[-1]
+                    stripped_data = "failed to render a log line (" + _text(error) + "): " + _text(repr(data))
+                if to_console:
+                    print(stripped_data)
+                if to_file:
+                    lines.setdefault(flavor, []).append("[" + unicode(when) + "]: " + stripped_data + "\n")
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                for flavor in lines:
+                    lines[flavor].append("[" + unicode(datetime.datetime.now()) + "]: " +
+                                         str(dropped) + " log lines have been dropped\n")
+            for flavor, chunk in lines.items():
+                try:
+                    self._append(flavor, chunk)
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            # whoever is flushing gets woken up, even if writing has failed
+            for written in flushed:
+                written.set()
+
+    def _render(self, data, args):
+        data = _text(data)
+        if not args:
+            return data
+        args = tuple(self._preview(arg) for arg in args)
+        try:
+            return data % args
+        except (TypeError, ValueError):
+            return " ".join((data,) + args)
+
+    def _preview(self, arg):
+        text = _text(arg)
+        if self.preview_length and len(text) > self.preview_length:
+            return text[:self.preview_length] + "... (" + str(len(text) - self.preview_length) + " more characters)"
+        return text
+
+    def _append(self, flavor, chunk):
+        f = self._open(flavor)
+        if not f:
+            return
+        size = os.fstat(f.fileno()).st_size
+        pending = []
+        for line in chunk:
+            encoded = line.encode("utf-8")
+            pending.append(encoded)
+            size += len(encoded)
+            if size >= self.max_size:
+                f.write(b"".join(pending))
+                pending = []
+                self._rotate(flavor)
+                f = self._open(flavor)
+                if not f:
+                    return
+                size = 0
+        f.write(b"".join(pending))
+        f.flush()
+
+    def _open(self, flavor):
+        f = self._files.get(flavor)
+        file_name = os.path.join(self.log_root, flavor + ".log")
+        if f and f.name != file_name:
+            f.close()  # the log root has moved
+            f = None
+        if not f:
+            try:
+                if not os.path.exists(self.log_root):
+                    os.mkdir(self.log_root)
+                f = self._files[flavor] = open(file_name, "ab")
+            except:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                detailed_info = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
+                print(detailed_info)
+                return None
+        return f
+
+    def _rotate(self, flavor):
+        # flavor.log becomes flavor.log.1, flavor.log.1 becomes flavor.log.2 and so on,
+        # up to "log_max_files" files in total
+        self._files.pop(flavor).close()
+        file_name = os.path.join(self.log_root, flavor + ".log")
+        try:
+            for i in range(self.max_files - 1, 0, -1):
+                older = file_name + "." + str(i)
+                if os.path.exists(older):
+                    os.remove(older)
+                newer = file_name + ("." + str(i - 1) if i > 1 else "")
+                if os.path.exists(newer):
+                    os.rename(newer, older)
+            if self.max_files <= 1:
+                os.remove(file_name)
+        except OSError:
+            traceback.print_exc()
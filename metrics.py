@@ -0,0 +1,168 @@
+import threading, time
+
+# counters and timings of the client, kept in memory and rendered by the "Ensime metrics" view.
+# latencies and parse times are kept for the most recent samples only,
+# so that the numbers follow what's going on now rather than averaging over the whole day
+
+
+class Histogram(object):
+    """The last `size` samples of a timing, in seconds."""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.count = 0
+        self._samples = []
+
+    def add(self, value):
+        if len(self._samples) < self.size:
+            self._samples.append(value)
+        else:
+            self._samples[self.count % self.size] = value
+        self.count += 1
+
+    def percentiles(self, *ps):
+        """Returns the requested percentiles of the recent samples (e.g. 50, 90, 99), or Nones if there are none."""
+        samples = sorted(self._samples)
+        if not samples:
+            return [None] * len(ps)
+        return [samples[min(len(samples) - 1, int(len(samples) * p / 100.0))] for p in ps]
+
+    def max(self):
+        return max(self._samples) if self._samples else None
+
+
+class Rate(object):
+    """Counts events per second over the last `window` seconds."""
+
+    def __init__(self, window=10):
+        self.window = window
+        self.total = 0
+        self._buckets = []  # [second, count] pairs, oldest first
+
+    def add(self, n=1, now=None):
+        second = int(now or time.time())
+        if self._buckets and self._buckets[-1][0] == second:
+            self._buckets[-1][1] += n
+        else:
+            self._buckets.append([second, n])
+            self._expire(second)
+        self.total += n
+
+    def per_second(self, now=None):
+        second = int(now or time.time())
+        self._expire(second)
+        return sum(count for bucket, count in self._buckets if bucket < second) / float(self.window)
+
+    def _expire(self, second):
+        while self._buckets and self._buckets[0][0] <= second - self.window - 1:
+            self._buckets.pop(0)
+
+
+class Registry(object):
+    """Metrics of a client: latencies per swank method, parse times per message type and traffic.
+    Updated from the I/O thread and read from the UI thread, hence the lock."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.latencies = {}  # swank method -> Histogram
+        self.parse_times = {}  # message type or swank method -> Histogram
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.sent = Rate()
+        self.received = Rate()
+        self._lock = threading.Lock()
+
+    def _add(self, histograms, name, seconds):
+        self._lock.acquire()
+        try:
+            histogram = histograms.get(name)
+            if not histogram:
+                histogram = histograms[name] = Histogram()
+            histogram.add(seconds)
+        finally:
+            self._lock.release()
+
+    def record_latency(self, method, seconds):
+        self._add(self.latencies, method, seconds)
+
+    def record_parse(self, message_type, seconds):
+        self._add(self.parse_times, message_type, seconds)
+
+    def timed(self, message_type, parser):
+        """Wraps `parser`, so that the time it takes goes into the parse times of `message_type`."""
+        def wrapped(payload):
+            start = time.time()
+            try:
+                return parser(payload)
+            finally:
+                self.record_parse(message_type, time.time() - start)
+
+        return wrapped
+
+    def record_sent(self, nbytes, messages):
+        self._lock.acquire()
+        try:
+            self.bytes_sent += nbytes
+            self.sent.add(messages)
+        finally:
+            self._lock.release()
+
+    def record_received(self, nbytes, messages=0):
+        self._lock.acquire()
+        try:
+            self.bytes_received += nbytes
+            if messages:
+                self.received.add(messages)
+        finally:
+            self._lock.release()
+
+    def render(self, in_flight=None, extras=None):
+        """Renders the metrics as text. `in_flight` maps swank methods to the number of pending requests,
+        and `extras` is a list of (caption, value) pairs shown along with the traffic."""
+        in_flight = in_flight or {}
+        self._lock.acquire()
+        try:
+            lines = ["Ensime metrics, collected over the last " + _duration(time.time() - self.started), ""]
+            traffic = [
+                ("sent", _size(self.bytes_sent) + " in " + str(self.sent.total) + " messages, " +
+                 "%.1f messages/s" % self.sent.per_second()),
+                ("received", _size(self.bytes_received) + " in " + str(self.received.total) + " messages, " +
+                 "%.1f messages/s" % self.received.per_second()),
+                ("in flight", str(sum(in_flight.values())) + " requests"),
+            ]
+            for caption, value in traffic + list(extras or []):
+                lines.append("%-24s %s" % (caption + ":", value))
+
+            lines += ["", "%-40s %7s %9s %9s %9s %9s %9s" % (
+                "latency (ms)", "count", "in flight", "p50", "p90", "p99", "max")]
+            for method in sorted(set(self.latencies) | set(in_flight)):
+                histogram = self.latencies.get(method) or Histogram()
+                lines.append("%-40s %7d %9d %s" % (method, histogram.count, in_flight.get(method, 0),
+                                                  _timings(histogram)))
+
+            lines += ["", "%-40s %7s %9s %9s %9s %9s %9s" % ("parse time (ms)", "count", "", "p50", "p90", "p99", "max")]
+            for message_type in sorted(self.parse_times):
+                histogram = self.parse_times[message_type]
+                lines.append("%-40s %7d %9s %s" % (message_type, histogram.count, "", _timings(histogram)))
+            return "\n".join(lines)
+        finally:
+            self._lock.release()
+
+
+def _timings(histogram):
+    values = histogram.percentiles(50, 90, 99) + [histogram.max()]
+    return " ".join("%9s" % ("-" if value is None else "%.1f" % (value * 1000)) for value in values)
+
+
+def _size(nbytes):
+    for unit in ["B", "KB", "MB"]:
+        if nbytes < 1024:
+            return "%d %s" % (nbytes, unit) if unit == "B" else "%.1f %s" % (nbytes, unit)
+        nbytes /= 1024.0
+    return "%.1f GB" % nbytes
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
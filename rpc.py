@@ -1,25 +1,113 @@
 from __future__ import unicode_literals
-import inspect, functools
+import inspect, functools, threading, traceback, time
 from functools import partial as bind
 import sexp
 from sexp import key, sym
 
 # ############################# DATA STRUCTURES ##############################
 
+_required = object()
+_missing = object()
+
+
+class Field(object):
+    """Declares how an attribute of a record is decoded from its plist.
+    `key` is the plist key and `attr` is the attribute it ends up in.
+    Fields without a `default` must be present in the plist.
+    Values can be converted either with a function (`convert`) or by parsing them
+    as a record type given by its name (`record`), possibly a list of such records (`many`)."""
+
+    def __init__(self, key, attr, default=_required, convert=None, record=None, many=False):
+        self.key = key
+        self.attr = attr
+        self.default = default
+        self.convert = convert
+        self.record = record
+        self.many = many
+
+
+def _compile_decoder(cls):
+    """Turn the field spec of a record type into a straight-line function
+    that parses a record from a raw data structure, skipping everything the spec doesn't mention."""
+    namespace = {"new": object.__new__, "cls": cls, "missing": _missing,
+                 "Deferred": sexp.Deferred, "key_map": sexp.sexp_to_key_map}
+    lines = []
+    for i, field in enumerate(cls.field_spec):
+        k, d, c = repr(field.key), "d%d" % i, "c%d" % i
+        if field.record:
+            record = globals()[field.record]
+            convert = record.parse_list if field.many else record.parse
+        else:
+            convert = field.convert
+        namespace[d], namespace[c] = field.default, convert
+        converted = (c + "(%s)") if convert else "%s"
+        if field.default is _required:
+            lines.append("    self.%s = %s" % (field.attr, converted % ("m[%s]" % k)))
+        elif convert or field.default == []:
+            # default lists are created anew, so that records don't end up sharing them
+            default = "[]" if field.default == [] else d
+            lines.append("    v = get(%s, missing)" % k)
+            lines.append("    self.%s = %s if v is missing else %s" % (field.attr, default, converted % "v"))
+        else:
+            lines.append("    self.%s = get(%s, %s)" % (field.attr, k, d))
+    # everything the function needs is bound to its parameters, which makes for the fastest lookups
+    params = ", ".join("%s=%s" % (name, name) for name in sorted(namespace))
+    lines[:0] = [
+        "def decode(raw, %s):" % params,
+        "    if type(raw) is Deferred:",
+        "        raw = raw.force(True)",
+        "    if not raw:",
+        "        return None",
+        "    m = raw if type(raw) is dict else key_map(raw)",
+        "    self = new(cls)",
+        "    get = m.get"]
+    lines.append("    return self")
+    exec("\n".join(lines), namespace)
+    return namespace["decode"]
+
+
+_decoders = {}
+
+# the same handful of file names comes up in thousands of notes and positions,
+# so records share a single copy of each of them
+_file_names = {}
+
+
+def _file_name(name):
+    return _file_names.setdefault(name, name)
+
+
+def _decoder(cls):
+    decode = _decoders.get(cls)
+    if decode is None:
+        decode = _decoders[cls] = _compile_decoder(cls)
+    return decode
+
+
 class ActiveRecord(object):
+    # records either declare their `field_spec` or implement `populate` by hand
+    # high-volume records also declare `__slots__` to keep their instances compact
+    __slots__ = ()
+    field_spec = None
+
     @classmethod
     def parse_list(cls, raw):
+        raw = sexp.force(raw, plists=True)
         if not raw: return []
-        if type(raw[0]) == type(key(":key")):
+        parse = _decoder(cls) if cls.field_spec is not None else cls.parse
+        if type(raw) is dict or type(raw[0]) is sexp.Keyword:
             m = sexp.sexp_to_key_map(raw)
             field = ":" + cls.__name__.lower() + "s"
-            return [cls.parse(raw) for raw in (m[field] if field in m else [])]
+            return [parse(raw) for raw in (m[field] if field in m else [])]
         else:
-            return [cls.parse(raw) for raw in raw]
+            return [parse(raw) for raw in raw]
 
     @classmethod
     def parse(cls, raw):
         """Parse a data type from a raw data structure"""
+        if cls.field_spec is not None:
+            return _decoder(cls)(raw)
+        raw = sexp.force(raw, plists=True)
         if not raw: return None
         value_map = sexp.sexp_to_key_map(raw)
         self = cls()
@@ -31,21 +119,30 @@ class ActiveRecord(object):
         raise Exception("abstract method: ActiveRecord.unparse - on " + str(this))
 
     def __str__(self):
-        return str(self.__dict__)
+        if hasattr(self, "__dict__"):
+            return str(self.__dict__)
+        return str(dict((name, getattr(self, name, None)) for name in self.__slots__))
 
 
 class Note(ActiveRecord):
-    def populate(self, m):
-        self.message = m[":msg"]
-        self.file_name = m[":file"]
-        self.severity = m[":severity"]
-        self.start = m[":beg"]
-        self.end = m[":end"]
-        self.line = m[":line"]
-        self.col = m[":col"]
+    __slots__ = ("message", "file_name", "severity", "start", "end", "line", "col")
+    field_spec = [
+        Field(":msg", "message"),
+        Field(":file", "file_name", convert=_file_name),
+        Field(":severity", "severity"),
+        Field(":beg", "start"),
+        Field(":end", "end"),
+        Field(":line", "line"),
+        Field(":col", "col"),
+    ]
 
 
 class CompletionInfoList(ActiveRecord):
+    field_spec = [
+        Field(":prefix", "prefix"),
+        Field(":completions", "completions", record="CompletionInfo", many=True),
+    ]
+
     @classmethod
     def create(cls, prefix, completions):
         self = CompletionInfoList()
@@ -53,10 +150,6 @@ class CompletionInfoList(ActiveRecord):
         self.completions = completions
         return self
 
-    def populate(self, m):
-        self.prefix = m[":prefix"]
-        self.completions = CompletionInfo.parse_list(m[":completions"])
-
 
 class CompletionSignature(ActiveRecord):
     """A completion signature consists of the parameter 'sections' which is a list of name to type) and a 'result' type.
@@ -88,12 +181,14 @@ class CompletionSignature(ActiveRecord):
 
 
 class CompletionInfo(ActiveRecord):
-    def populate(self, m):
-        self.name = m[":name"]
-        self.signature = CompletionSignature.from_raw(m[":type-sig"])
-        self.is_callable = bool(m[":is-callable"]) if ":is-callable" in m else False
-        self.type_id = m[":type-id"]
-        self.to_insert = m[":to-insert"] if ":to-insert" in m else None
+    __slots__ = ("name", "signature", "is_callable", "type_id", "to_insert")
+    field_spec = [
+        Field(":name", "name"),
+        Field(":type-sig", "signature", convert=CompletionSignature.from_raw),
+        Field(":is-callable", "is_callable", False, convert=bool),
+        Field(":type-id", "type_id"),
+        Field(":to-insert", "to_insert", None),
+    ]
 
     def __repr__(self):
         return 'CompletionInfo("{self.name}", "{self.signature}", {self.is_callable}, {self.type_id}, ...)'.format(
@@ -101,40 +196,41 @@ class CompletionInfo(ActiveRecord):
 
 
 class SourcePosition(ActiveRecord):
-    def populate(self, m):
-        self.file_name = m[":file"] if ":file" in m else None
-        self.offset = m[":offset"] if ":offset" in m else None
-        self.start = m[":start"] if ":start" in m else None
-        self.end = m[":end"] if ":end" in m else None
+    __slots__ = ("file_name", "offset", "start", "end")
+    field_spec = [
+        Field(":file", "file_name", None, convert=_file_name),
+        Field(":offset", "offset", None),
+        Field(":start", "start", None),
+        Field(":end", "end", None),
+    ]
 
 
 class SymbolInfo(ActiveRecord):
-    def populate(self, m):
-        self.name = m[":name"]
-        self.type = TypeInfo.parse(m[":type"])
-        self.decl_pos = SourcePosition.parse(m[":decl-pos"]) if ":decl-pos" in m else None
-        self.is_callable = bool(m[":is-callable"]) if ":is-callable" in m else False
-        self.owner_type_id = m[":owner-type-id"] if ":owner-type-id" in m else None
+    field_spec = [
+        Field(":name", "name"),
+        Field(":type", "type", record="TypeInfo"),
+        Field(":decl-pos", "decl_pos", None, record="SourcePosition"),
+        Field(":is-callable", "is_callable", False, convert=bool),
+        Field(":owner-type-id", "owner_type_id", None),
+    ]
 
 
 class TypeInfo(ActiveRecord):
-    def populate(self, m):
-        self.name = m[":name"]
-        self.type_id = m[":type-id"]
-        isArrowType = bool(m[":arrow-type"]) if ":arrow-type" in m else False
-        if isArrowType:
-            self.arrow_type = True
-            self.result_type = TypeInfo.parse(m[":result-type"])
-            self.param_sections = ParamSectionInfo.parse_list(m[":param-sections"]) if ":param-sections" in m else []
-        else:
-            # Basic type
-            self.arrow_type = False
-            self.full_name = m[":full-name"] if ":full-name" in m else None
-            self.decl_as = m[":decl-as"] if ":decl-as" in m else None
-            self.decl_pos = SourcePosition.parse(m[":pos"]) if ":pos" in m else None
-            self.type_args = TypeInfo.parse_list(m[":type-args"]) if ":type-args" in m else []
-            self.outer_type_id = m[":outer-type-id"] if ":outer-type-id" in m else None
-            self.members = Member.parse_list(m[":members"]) if ":members" in m else []
+    # arrow types only come with a result type and parameter sections,
+    # basic types come with the rest, and the attributes of the other kind are left at their defaults
+    field_spec = [
+        Field(":name", "name"),
+        Field(":type-id", "type_id"),
+        Field(":arrow-type", "arrow_type", False, convert=bool),
+        Field(":result-type", "result_type", None, record="TypeInfo"),
+        Field(":param-sections", "param_sections", [], record="ParamSectionInfo", many=True),
+        Field(":full-name", "full_name", None),
+        Field(":decl-as", "decl_as", None),
+        Field(":pos", "decl_pos", None, record="SourcePosition"),
+        Field(":type-args", "type_args", [], record="TypeInfo", many=True),
+        Field(":outer-type-id", "outer_type_id", None),
+        Field(":members", "members", [], record="Member", many=True),
+    ]
 
 
 class SymbolSearchResults(ActiveRecord):
@@ -143,6 +239,7 @@ class SymbolSearchResults(ActiveRecord):
     # and calls sexp_to_key_map
     @classmethod
     def parse(cls, raw):
+        raw = sexp.force(raw, plists=True)
         if not raw: return None
         self = cls()
         self.populate(raw)
@@ -153,11 +250,12 @@ class SymbolSearchResults(ActiveRecord):
 
 
 class SymbolSearchResult(ActiveRecord):
-    def populate(self, m):
-        self.name = m[":name"]
-        self.local_name = m[":local-name"]
-        self.decl_as = m[":decl-as"] if ":decl-as" in m else None
-        self.pos = SourcePosition.parse(m[":pos"]) if ":pos" in m else None
+    field_spec = [
+        Field(":name", "name"),
+        Field(":local-name", "local_name"),
+        Field(":decl-as", "decl_as", None),
+        Field(":pos", "pos", None, record="SourcePosition"),
+    ]
 
 
 class RefactorResult(ActiveRecord):
@@ -166,20 +264,17 @@ class RefactorResult(ActiveRecord):
 
 
 class Member(ActiveRecord):
-    def populate(self, m):
-        pass
-
+    field_spec = []
 
 class ParamSectionInfo(ActiveRecord):
-    def populate(self, m):
-        self.is_implicit = bool(m[":is-implicit"]) if ":is-implicit" in m else False
-        self.params = Param.parse_list(m[":params"]) if ":params" in m else []
+    field_spec = [
+        Field(":is-implicit", "is_implicit", False, convert=bool),
+        Field(":params", "params", [], record="Param", many=True),
+    ]
 
 
 class Param(ActiveRecord):
-    def populate(self, m):
-        pass
-
+    field_spec = []
 
 class DebugEvent(ActiveRecord):
     def populate(self, m):
@@ -233,17 +328,19 @@ class DebugKickoffResult(ActiveRecord):
 
 
 class DebugBacktrace(ActiveRecord):
-    def populate(self, m):
-        self.frames = DebugStackFrame.parse_list(m[":frames"]) if ":frames" in m else []
-        self.thread_id = m[":thread-id"]
-        self.thread_name = m[":thread-name"]
+    field_spec = [
+        Field(":frames", "frames", [], record="DebugStackFrame", many=True),
+        Field(":thread-id", "thread_id"),
+        Field(":thread-name", "thread_name"),
+    ]
 
 
 class SourceFileInfo(ActiveRecord):
-    def populate(self, m):
-        self.file = m[":file"]
-        self.contents = m[":contents"] if ":contents" in m else None
-        self.contents_in = m[":contents-in"] if ":contents-in" in m else None
+    field_spec = [
+        Field(":file", "file"),
+        Field(":contents", "contents", None),
+        Field(":contents-in", "contents_in", None),
+    ]
 
     def __init__(self, file_name, contents=None, contents_in=None):
         self.file = file_name
@@ -260,52 +357,59 @@ class SourceFileInfo(ActiveRecord):
         return [base]
 
 class DebugStackFrame(ActiveRecord):
-    def populate(self, m):
-        self.index = m[":index"]
-        self.locals = DebugStackLocal.parse_list(m[":locals"]) if ":locals" in m else []
-        self.num_args = m[":num-args"]
-        self.class_name = m[":class-name"]
-        self.method_name = m[":method-name"]
-        self.pc_location = DebugSourcePosition.parse(m[":pc-location"])
-        self.this_object_id = m[":this-object-id"]
+    field_spec = [
+        Field(":index", "index"),
+        Field(":locals", "locals", [], record="DebugStackLocal", many=True),
+        Field(":num-args", "num_args"),
+        Field(":class-name", "class_name"),
+        Field(":method-name", "method_name"),
+        Field(":pc-location", "pc_location", record="DebugSourcePosition"),
+        Field(":this-object-id", "this_object_id"),
+    ]
 
 
 class DebugSourcePosition(ActiveRecord):
-    def populate(self, m):
-        self.file_name = m[":file"]
-        self.line = m[":line"]
+    field_spec = [
+        Field(":file", "file_name", convert=_file_name),
+        Field(":line", "line"),
+    ]
 
 
 class DebugStackLocal(ActiveRecord):
-    def populate(self, m):
-        self.index = m[":index"]
-        self.name = m[":name"]
-        self.summary = m[":summary"]
-        self.type_name = m[":type-name"]
+    __slots__ = ("index", "name", "summary", "type_name")
+    field_spec = [
+        Field(":index", "index"),
+        Field(":name", "name"),
+        Field(":summary", "summary"),
+        Field(":type-name", "type_name"),
+    ]
+
+
+def _debug_value_type(value_type):
+    if str(value_type) not in ("null", "prim", "obj", "str", "arr"):
+        raise Exception("unexpected debug value of type " + str(value_type))
+    return value_type
 
 
 class DebugValue(ActiveRecord):
-    def populate(self, m):
-        self.type = m[":val-type"]
-        self.type_name = m[":type-name"]
-        self.length = m[":length"] if ":length" in m else None
-        self.element_type_name = m[":element-type-name"] if ":element-type-name" in m else None
-        self.summary = m[":summary"] if ":summary" in m else None
-        self.object_id = m[":object-id"] if ":object-id" in m else None
-        self.fields = DebugObjectField.parse_list(m[":fields"]) if ":fields" in m else []
-        if str(self.type) == "null" or str(self.type) == "prim" or str(self.type) == "obj" or str(
-                self.type) == "str" or str(self.type) == "arr":
-            pass
-        else:
-            raise Exception("unexpected debug value of type " + str(self.type) + ": " + str(m))
+    field_spec = [
+        Field(":val-type", "type", convert=_debug_value_type),
+        Field(":type-name", "type_name"),
+        Field(":length", "length", None),
+        Field(":element-type-name", "element_type_name", None),
+        Field(":summary", "summary", None),
+        Field(":object-id", "object_id", None),
+        Field(":fields", "fields", [], record="DebugObjectField", many=True),
+    ]
 
 
 class DebugObjectField(ActiveRecord):
-    def populate(self, m):
-        self.index = m[":index"]
-        self.name = m[":name"]
-        self.summary = m[":summary"]
-        self.type_name = m[":type-name"]
+    field_spec = [
+        Field(":index", "index"),
+        Field(":name", "name"),
+        Field(":summary", "summary"),
+        Field(":type-name", "type_name"),
+    ]
 
 
 class DebugLocation(ActiveRecord):
@@ -365,6 +469,211 @@ class DebugLocationSlot(DebugLocation):
              self.offset]]
 
 
+# ############################# FUTURES ##############################
+
+def _invoke(fn, future, on_ui_thread):
+    # the result is only worked out on the thread that runs the callback,
+    # so that replies aren't parsed on the I/O thread, which serves all windows
+    if on_ui_thread:
+        import ui  # imported here, so that records can be used outside of Sublime (e.g. in benchmarks)
+        ui.call(_call_with_result, fn, future)
+    else:
+        try:
+            _call_with_result(fn, future)
+        except Exception:
+            traceback.print_exc()
+
+
+def _call_with_result(fn, future):
+    fn(future._get())
+
+
+def _result_of(future):
+    return future._get()
+
+
+class RpcFuture(object):
+    """The eventual result of an rpc request.
+    Wait for it with `result`, or get notified with `add_done_callback` and `then`.
+    The reply is parsed the first time someone looks at it, on the thread that does the looking.
+    Failed and cancelled requests end up with None, and `failed` tells them apart from empty results."""
+
+    def __init__(self, parser=None, timeout=None):
+        self.parser = parser
+        self.timeout = timeout
+        self.failed = False
+        self.cancelled = False
+        self.on_cancel = None
+        self._payload = _missing
+        self._value = None
+        self._event = threading.Event()
+        self._lock = threading.RLock()
+        self._callbacks = []
+        self._hooks = []
+
+    def done(self):
+        return self._event.isSet()
+
+    def set_payload(self, payload):
+        """Resolves the future with the raw payload of a reply."""
+        self._resolve(payload, False, parse=True)
+
+    def set_result(self, value):
+        self._resolve(value, False)
+
+    def set_failed(self):
+        self._resolve(None, True)
+
+    def _follow(self, other):
+        """Resolves the future with the outcome of `other`, without parsing the reply of `other` just yet."""
+        self.parser = _result_of
+        self._resolve(other, other.failed, parse=True)
+
+    def _resolve(self, value, failed, parse=False):
+        self._lock.acquire()
+        try:
+            if self._event.isSet():
+                return
+            if parse and self.parser:
+                self._payload = value
+            else:
+                self._value = value
+            self.failed = failed
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+            hooks, self._hooks = self._hooks, []
+        finally:
+            self._lock.release()
+        self._run_hooks(hooks)
+        for fn, on_ui_thread in callbacks:
+            _invoke(fn, self, on_ui_thread)
+
+    def _run_hooks(self, hooks):
+        for fn in hooks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+
+    def _get(self):
+        self._lock.acquire()
+        try:
+            if self._payload is not _missing:
+                payload, self._payload = self._payload, _missing
+                try:
+                    self._value = self.parser(payload)
+                except Exception:
+                    traceback.print_exc()
+                    self.failed = True
+            return self._value
+        finally:
+            self._lock.release()
+
+    def result(self, timeout=None):
+        """Waits for the result for at most `timeout` seconds (by default, the timeout of the request).
+        Returns None if the result doesn't arrive in time, but the request stays alive."""
+        self._event.wait(timeout if timeout is not None else self.timeout)
+        return self._get()
+
+    def add_done_callback(self, fn, on_ui_thread=True):
+        """Calls `fn(result)` once the future is resolved, or straight away if it already is.
+        Unless `on_ui_thread` is off, `fn` is run on the UI thread.
+        Otherwise it runs on whatever thread resolves the future (usually the I/O thread), so it must be quick,
+        and it has the reply parsed right there. Bookkeeping that doesn't need the result should use `add_done_hook`."""
+        self._lock.acquire()
+        try:
+            if not self._event.isSet():
+                self._callbacks.append((fn, on_ui_thread))
+                return self
+            if self.cancelled:
+                return self
+        finally:
+            self._lock.release()
+        _invoke(fn, self, on_ui_thread)
+        return self
+
+    def add_done_hook(self, fn):
+        """Calls `fn(future)` once the future is done, whatever the outcome (cancellation included),
+        on the thread that finishes it. The reply isn't parsed for the hook, so it's cheap enough for the I/O thread."""
+        self._lock.acquire()
+        try:
+            if not self._event.isSet():
+                self._hooks.append(fn)
+                return self
+        finally:
+            self._lock.release()
+        self._run_hooks([fn])
+        return self
+
+    def cancel(self):
+        """Gives up on the request. Its reply will be dropped, and the callbacks won't be called (but the hooks will)."""
+        self._lock.acquire()
+        try:
+            if self._event.isSet():
+                return False
+            self.cancelled = self.failed = True
+            self._callbacks = []
+            self._event.set()
+            hooks, self._hooks = self._hooks, []
+        finally:
+            self._lock.release()
+        self._run_hooks(hooks)
+        if self.on_cancel:
+            self.on_cancel()
+        return True
+
+    def then(self, fn, on_ui_thread=True):
+        """Chains another step: returns the future of `fn(result)`, where `fn` can return another future.
+        Like callbacks, steps run on the UI thread unless `on_ui_thread` is off.
+        When a step fails, the following ones are skipped, and cancelling the chain cancels the step in progress."""
+        chained = RpcFuture()
+        chained.on_cancel = self.cancel
+
+        def step(value):
+            if self.failed:
+                chained.set_failed()
+                return
+            try:
+                value = fn(value)
+            except Exception:
+                traceback.print_exc()
+                chained.set_failed()
+                return
+            if isinstance(value, RpcFuture):
+                chained.on_cancel = value.cancel
+                value.add_done_hook(chained._follow)
+            else:
+                chained.set_result(value)
+
+        self.add_done_callback(step, on_ui_thread)
+        return chained
+
+
+def gather(futures):
+    """Returns the future of the list of results of `futures`, which is resolved once all of them are done.
+    It fails if any of them does, but the results of the others are still there."""
+    combined = RpcFuture(lambda futures: [future._get() for future in futures])
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    combined.on_cancel = lambda: [future.cancel() for future in futures]
+
+    def collect(_):
+        lock.acquire()
+        try:
+            remaining[0] -= 1
+            done = not remaining[0]
+        finally:
+            lock.release()
+        if done:
+            combined._resolve(futures, any(future.failed for future in futures), parse=True)
+
+    for future in futures:
+        future.add_done_hook(collect)
+    if not futures:
+        combined.set_result([])
+    return combined
+
+
 # ############################# REMOTE PROCEDURES ##############################
 
 def _mk_req(func, *args, **kwargs):
@@ -399,56 +708,237 @@ def _mk_req(func, *args, **kwargs):
     return req
 
 
-def async_rpc(*args):
-    parser = args[0] if args else lambda raw: raw
+def async_rpc(*args, **options):
+    """Turns a method into an rpc call that returns an `RpcFuture` of the parsed reply.
+    Callers can pass the view a request is about as `view=...`,
+    and override the priority of a single call with `background=...`.
+    With `supersede=True`, a request then cancels the previous request of the same method for that view,
+    since only the latest one matters (e.g. completions while typing).
+    With `coalesce=True`, a request identical to one that's still in flight isn't sent again,
+    and the caller gets the future of the pending request instead.
+    With `cache=True`, replies are cached for the current contents of the view (see `ResponseCache`),
+    which only makes sense for requests that don't change anything.
+    With `background=True`, the request yields to interactive ones (see `Client.request`)."""
+    parser = args[0] if args else sexp.force
+    supersede = options.get("supersede", False)
+    coalesce = options.get("coalesce", False)
+    cache = options.get("cache", False)
+    background = options.get("background", False)
 
     def wrapper(func):
         def wrapped(*args, **kwargs):
             self = args[0]
-            if callable(args[-1]):
-                on_complete = args[-1]
-                args = args[:-1]
-            else:
-                on_complete = None
+            view = kwargs.pop("view", None)
+            in_background = kwargs.pop("background", background)
             req = _mk_req(func, *args, **kwargs)
-
-            def callback(payload):
-                data = parser(payload)
-                if (on_complete):
-                    on_complete(data)
-
-            self.env.controller.client.async_req(req, callback, call_back_into_ui_thread=True)
-
+            identity = sexp.to_string(req) if coalesce or cache else None
+            if cache and view is not None:
+                cache_key = (view.id(), view.change_count(), identity)
+                future = self.env.rpc_cache.get(cache_key)
+                if future is not None and not future.failed:
+                    if supersede:
+                        self._supersede((func.__name__, view.id()), future)
+                    return future
+            if coalesce:
+                # requests about different views aren't merged, because each view supersedes its own requests,
+                # and that would cancel the requests of the other views too
+                coalesce_key = (view.id() if view is not None else None, identity)
+                pending = self._pending(coalesce_key)
+                if pending:
+                    return pending
+            timeout = self.env.settings.get("timeout_" + func.__name__)
+            deadline = self.env.settings.get("deadline_" + func.__name__)
+            future = self.env.controller.client.request(req, parser, timeout, in_background, deadline)
+            if cache and view is not None:
+                future.add_done_hook(functools.partial(self._remember, cache_key))
+            if coalesce:
+                self._track(coalesce_key, future)
+            if supersede and view is not None:
+                self._supersede((func.__name__, view.id()), future)
+            return future
+
+        wrapped.request = functools.partial(_mk_req, func)
+        wrapped.parser = parser
         return wrapped
 
     return wrapper
 
 
-def sync_rpc(*args):
-    parser = args[0] if args else lambda raw: raw
-
-    def wrapper(func):
-        def wrapped(*args, **kwargs):
-            self = args[0]
-            req = _mk_req(func, *args, **kwargs)
-            timeout = self.env.settings.get("timeout_" + func.__name__)
-            raw = self.env.controller.client.sync_req(req, timeout=timeout)
-            return parser(raw)
-
-        return wrapped
-
-    return wrapper
+# marks calls whose callers usually wait for the result, the timeout comes from "timeout_<method name>"
+# (requests of both kinds are given up on after "deadline_<method name>", or "request_deadline")
+sync_rpc = async_rpc
+
+
+class ResponseCache(object):
+    """A bounded LRU cache of replies to read-only requests (the futures resolved with them).
+    Keys start with the id of the view a request is about and its change count,
+    so editing the view makes its entries unreachable, and they are evicted once the view caches something new.
+    Everything else that can change the answers (e.g. a new compiler run) has to `clear` the cache.
+    `hits` and `misses` tell how well it works for a given `capacity`."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._order = []  # least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self.hits += 1
+                self._order.remove(key)
+                self._order.append(key)
+                return self._entries[key]
+            self.misses += 1
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        if value is None or self.capacity <= 0:
+            return
+        self._lock.acquire()
+        try:
+            view_id, change_count = key[:2]
+            for stale in [k for k in self._order if k[0] == view_id and k[1] != change_count]:
+                self._evict(stale)
+            if key in self._entries:
+                self._order.remove(key)
+            self._entries[key] = value
+            self._order.append(key)
+            while len(self._order) > self.capacity:
+                self._evict(self._order[0])
+        finally:
+            self._lock.release()
+
+    def _evict(self, key):
+        del self._entries[key]
+        self._order.remove(key)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries = {}
+            self._order = []
+        finally:
+            self._lock.release()
+
+
+class RpcBatch(object):
+    """Collects calls to the methods of `Rpc` and then sends them all at once,
+    so that N requests cost a single round-trip instead of N of them:
+
+        batch = rpc.batch()
+        for bp in breakpoints:
+            batch.debug_set_break(bp.file_name, bp.line)
+        batch.send().add_done_callback(on_complete)  # or: results = batch.wait()
+
+    Results are parsed just like the results of the corresponding methods, and come in the order of the calls."""
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self._requests = []
+
+    def __len__(self):
+        return len(self._requests)
+
+    def __getattr__(self, name):
+        method = getattr(type(self.rpc), name, None)
+        if not hasattr(method, "request"):
+            raise AttributeError("cannot batch " + name + ", it's not an rpc method")
+
+        def add(*args, **kwargs):
+            self._requests.append((method.request(self.rpc, *args, **kwargs), method.parser))
+
+        return add
+
+    def submit(self):
+        """Sends the requests, and returns their futures."""
+        return self.rpc.env.controller.client.batch_request(self._requests)
+
+    def send(self):
+        """Sends the requests, and returns the future of the list of their results."""
+        return gather(self.submit())
+
+    def wait(self, timeout=None):
+        """Blocks until all the results are there or until the timeout expires, missing results are None."""
+        futures = self.submit()
+        deadline = time.time() + (timeout or self.rpc.env.controller.client.timeout)
+        return [future.result(max(0, deadline - time.time())) for future in futures]
 
 
 class Rpc(object):
     def __init__(self, env):
         self.env = env
+        # request tracking is shared by all Rpc objects of an environment
+        self._latest = env.rpc_latest
+        self._in_flight = env.rpc_in_flight
+        self._lock = env.rpc_lock
+
+    def batch(self):
+        return RpcBatch(self)
+
+    def _supersede(self, kind, future):
+        # the handler of the previous request is freed, and its reply will be dropped unparsed
+        self._lock.acquire()
+        try:
+            previous = self._latest.get(kind)
+            self._latest[kind] = future
+        finally:
+            self._lock.release()
+        if previous and previous.cancel():
+            self.env.controller.client.log_client("request superseded: " + str(kind))
+        future.add_done_hook(functools.partial(self._retire, kind))
+
+    def _retire(self, kind, future):
+        self._lock.acquire()
+        try:
+            if self._latest.get(kind) is future:
+                del self._latest[kind]
+        finally:
+            self._lock.release()
+
+    def _remember(self, cache_key, future):
+        # the future itself is cached, so that its reply gets parsed by whoever asks for it first, and only once
+        if not future.failed:
+            self.env.rpc_cache.put(cache_key, future)
+
+    def _pending(self, key):
+        self._lock.acquire()
+        try:
+            future = self._in_flight.get(key)
+            # cancelled requests are done as well
+            return future if future and not future.done() else None
+        finally:
+            self._lock.release()
+
+    def _track(self, key, future):
+        self._lock.acquire()
+        try:
+            self._in_flight[key] = future
+        finally:
+            self._lock.release()
+        future.add_done_hook(functools.partial(self._forget, key))
+
+    def _forget(self, key, future):
+        self._lock.acquire()
+        try:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+        finally:
+            self._lock.release()
 
     @sync_rpc()
     def shutdown_server(self):
         pass
 
-    @async_rpc()
+    @async_rpc(background=True)
     def typecheck_file(self, file):
         pass
 
@@ -456,19 +946,19 @@ class Rpc(object):
     def patch_source(self, file_name, edits):
         pass
 
-    @sync_rpc(CompletionInfoList.parse)
+    @sync_rpc(CompletionInfoList.parse, supersede=True)
     def completions(self, file_name, position, max_results, case_sensitive, reload_from_disk):
         pass
 
-    @async_rpc(TypeInfo.parse)
+    @async_rpc(TypeInfo.parse, supersede=True, coalesce=True, cache=True)
     def type_at_point(self, file_name, position):
         pass
 
-    @async_rpc(SymbolInfo.parse)
+    @async_rpc(SymbolInfo.parse, supersede=True, coalesce=True, cache=True)
     def symbol_at_point(self, file_name, position):
         pass
 
-    @async_rpc(SymbolSearchResults.parse_list)
+    @async_rpc(SymbolSearchResults.parse_list, cache=True)
     def import_suggestions(self, file_name, position, type_names, max_results):
         pass
 
@@ -476,6 +966,8 @@ class Rpc(object):
     def prepare_refactor(self, procedure_id, refactor_type, parameters, require_confirmation):
         pass
 
+    # breakpoints are set in the background when they are only synced with the session (see EnsimeToggleBreakpoint),
+    # but not while the user waits for the debugger to start
     @async_rpc()
     def debug_set_break(self, file_name, line):
         pass
@@ -496,32 +988,26 @@ class Rpc(object):
     def _debug_attach(self, host, port):
         pass
 
-    def debug_start(self, launch, breakpoints, on_complete=None):
-        def set_breakpoints(breakpoints, status):
-            if status:
-                if breakpoints:
-                    self.debug_set_break(breakpoints[0].file_name, breakpoints[0].line,
-                                         bind(set_breakpoints, breakpoints[1:]))
-                else:
-                    if launch.main_class:
-                        self._debug_start(launch.command_line, on_complete)
-                    elif launch.remote_address:
-                        self._debug_attach(launch.remote_host, launch.remote_port, on_complete)
-                    else:
-                        raise Exception("unsupported launch: " + str(launch))
-            elif on_complete:
-                on_complete(status)
-
-        def clear_breakpoints():
-            def callback(status):
-                if status:
-                    set_breakpoints(breakpoints, status)
-                elif on_complete:
-                    on_complete(status)
-
-            self.debug_clear_all_breaks(callback)
-
-        clear_breakpoints()
+    def debug_start(self, launch, breakpoints):
+        def set_breakpoints(status):
+            if not status:
+                return None
+            batch = self.batch()
+            for breakpoint in breakpoints:
+                batch.debug_set_break(breakpoint.file_name, breakpoint.line)
+            return batch.send()
+
+        def launch_debugger(statuses):
+            if statuses is None or not all(statuses):
+                return None  # an empty list means that there were no breakpoints to set
+            if launch.main_class:
+                return self._debug_start(launch.command_line)
+            elif launch.remote_address:
+                return self._debug_attach(launch.remote_host, launch.remote_port)
+            else:
+                raise Exception("unsupported launch: " + str(launch))
+
+        return self.debug_clear_all_breaks().then(set_breakpoints).then(launch_debugger)
 
     @async_rpc()
     def debug_stop(self):
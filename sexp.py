@@ -1,36 +1,92 @@
-import re
+import re, codecs
 
+# Keywords and symbols are interned: reading the same name twice yields the same object,
+# so atoms are cheap to compare, hash and keep around in large batches of notes.
+_keywords = {}
+_symbols = {}
 
-class Keyword:
-    def __init__(self, s):
-        self.val = s
+
+class Keyword(object):
+    __slots__ = ("val",)
+
+    def __new__(cls, s):
+        k = _keywords.get(s)
+        if k is None:
+            k = object.__new__(cls)
+            k.val = s
+            k = _keywords.setdefault(s, k)
+        return k
 
     def __repr__(self):
         return self.val
 
     def __eq__(self, k):
-        return type(k) == type(self) and self.val == k.val
+        return self is k or (type(k) == type(self) and self.val == k.val)
+
+    def __ne__(self, k):
+        return not self == k
 
+    def __hash__(self):
+        return hash(self.val)
 
-class Symbol:
-    def __init__(self, s):
-        self.val = s
+
+class Symbol(object):
+    __slots__ = ("val",)
+
+    def __new__(cls, s):
+        k = _symbols.get(s)
+        if k is None:
+            k = object.__new__(cls)
+            k.val = s
+            k = _symbols.setdefault(s, k)
+        return k
 
     def __repr__(self):
         return self.val
 
     def __eq__(self, k):
-        return type(k) == type(self) and self.val == k.val
+        return self is k or (type(k) == type(self) and self.val == k.val)
+
+    def __ne__(self, k):
+        return not self == k
+
+    def __hash__(self):
+        return hash(self.val)
+
+
+def plist_to_key_map(lst):
+    """Convert a list that looks like a plist, i.e. (:key1 val1 :key2 val2 ...),
+    into a dict that is keyed the same way `sexp_to_key_map` does it.
+    Returns None if the list isn't a plist."""
+    if not lst or len(lst) % 2:
+        return None
+    keys = lst[0::2]
+    for k in keys:
+        if type(k) is not Keyword:
+            return None
+    return dict(zip([k.val for k in keys], lst[1::2]))
+
+
+def _reads_plists(plists, stack):
+    """Decides whether a nested list that has just been closed should become a dict.
+    Top-level forms are never converted, since they are message envelopes rather than plists."""
+    if not plists or not stack:
+        return False
+    if plists is True:
+        return True
+    head = stack[0][0] if stack[0] else None
+    return type(head) is Keyword and head in plists
 
 
 def sexp_to_key_map(sexp):
+    if type(sexp) is dict:
+        return sexp  # already converted by the reader
     try:
-        key_type = type(key(":key"))
         result = {}
         for i in xrange(0, len(sexp), 2):
             k, val = sexp[i], sexp[i + 1]
-            if type(k) == key_type:
-                result[str(k)] = val
+            if type(k) is Keyword:
+                result[k.val] = val
         return result
     except:
         raise Exception("not a sexp: %s" % sexp)
@@ -44,9 +100,12 @@ def sym(s):
     return Symbol(s)
 
 
-def read(s):
-    """Read a sexp expression from a string."""
-    return read_form(s)[0]
+def read(s, plists=None):
+    """Read a sexp expression from a string.
+    Nested lists are read with an explicit stack,
+    so arbitrarily deep forms don't exhaust the Python stack.
+    See `read_form_iter` for the meaning of `plists`."""
+    return read_form_iter(s, 0, plists)[0]
 
 
 def read_relaxed(s):
@@ -58,167 +117,386 @@ def read_relaxed(s):
     lines = filter(lambda line: line, lines)
     lines = filter(lambda line: not line.startswith(";"), lines)
     s = '\n'.join(lines)
-    return read_form(s)[0]
+    return read_form_iter(s, 0)[0]
+
+
+# The readers below walk the input with an integer cursor instead of
+# re-slicing it, so reading a message is linear in its length.
+# Each of them takes the input and a position and returns (value, new position).
 
+_whitespace_re = re.compile(r"\s*", re.UNICODE)
+_string_re = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"', re.DOTALL)
+_unescape_re = re.compile(r"\\(.)", re.DOTALL)
+_atom_re = re.compile(r"'(\S*)\s", re.UNICODE)
+_keyword_re = re.compile(r":(?:[^\W_]|-)*", re.UNICODE)
+_symbol_re = re.compile(r"(?:[^\W_]|[-:])*", re.UNICODE)
+_int_re = re.compile(r"[0-9-]*")
 
-def read_form(str):
+
+def read_form(str, pos=0):
     """Read a form."""
-    if len(str) == 0:
+    if pos >= len(str):
         raise SyntaxError('unexpected EOF while reading form')
-    ch = str[0]
+    ch = str[pos]
     if ch.isspace():
         raise SyntaxError('unexpected whitespace while reading form')
     elif ch == '(':
-        return read_list(str)
+        return read_list(str, pos)
     elif ch == '"':
-        return read_string(str)
+        return read_string(str, pos)
     elif ch == ':':
-        return read_keyword(str)
+        return read_keyword(str, pos)
     elif ch.isdigit() or ch == "-":
-        return read_int(str)
+        return read_int(str, pos)
     elif ch.isalpha():
-        return read_symbol(str)
+        return read_symbol(str, pos)
     elif ch == '\'':
-        return read_atom(str)
+        return read_atom(str, pos)
     else:
         raise SyntaxError('unexpected character in read_form: ' + ch)
 
 
-def read_list(str):
+def read_form_iter(str, pos=0, plists=None):
+    """Read a form like `read_form` does, but without recursing into nested lists.
+    Open lists are kept on an explicit stack, atoms are delegated to `read_form`.
+    If `plists` is True, nested plists are returned as dicts (see `plist_to_key_map`).
+    If it's a collection of keywords, that only happens inside top-level forms headed by one of them."""
+    end = len(str)
+    stack = []
+    while True:
+        if stack:
+            pos = _whitespace_re.match(str, pos).end()
+            if pos >= end:
+                raise SyntaxError('EOF while reading list')
+        elif pos >= end:
+            raise SyntaxError('unexpected EOF while reading form')
+        ch = str[pos]
+        if ch == '(':
+            stack.append([])
+            pos += 1
+            continue
+        elif ch == ')' and stack:
+            val = stack.pop()
+            pos += 1
+            if _reads_plists(plists, stack):
+                val = plist_to_key_map(val) or val
+        else:
+            val, pos = read_form(str, pos)
+        if not stack:
+            return (val, pos)
+        stack[-1].append(val)
+
+
+def read_list(str, pos=0):
     """Read a list from a string."""
-    if len(str) == 0:
+    if pos >= len(str):
         raise SyntaxError('unexpected EOF while reading list')
-    if str[0] != '(':
-        raise SyntaxError('expected ( as first char of list: ' + str)
-    str = str[1:]
+    if str[pos] != '(':
+        raise SyntaxError('expected ( as first char of list: ' + str[pos:])
+    end = len(str)
+    pos += 1
     lst = []
-    while (len(str) > 0):
-        ch = str[0]
-        if ch.isspace():
-            str = str[1:]
-            continue
-        elif ch == ')':
-            return (lst, str[1:])
-        else:
-            val, remain = read_form(str)
-            lst.append(val)
-            str = remain
-    raise SyntaxError('EOF while reading list')
+    while True:
+        pos = _whitespace_re.match(str, pos).end()
+        if pos >= end:
+            raise SyntaxError('EOF while reading list')
+        if str[pos] == ')':
+            return (lst, pos + 1)
+        val, pos = read_form(str, pos)
+        lst.append(val)
 
 
-def read_string(str):
+def read_string(str, pos=0):
     """Read a string."""
-    if len(str) == 0:
+    if pos >= len(str):
         raise SyntaxError('unexpected EOF while reading string')
-    if str[0] != '"':
-        raise SyntaxError('expected ( as first char of string: ' + str)
-    str = str[1:]
-    s = ""
-    escaped = False
-    while (len(str) > 0):
-        ch = str[0]
-        if ch == '"' and not escaped:
-            return (s, str[1:])
-        elif escaped:
-            escaped = False
-            s = s[:-1]  # remove the escaping backslash
-        elif ch == "\\":
-            escaped = True
-        s = s + ch
-        str = str[1:]
-    raise SyntaxError('EOF while reading string')
-
-
-def read_atom(str):
+    if str[pos] != '"':
+        raise SyntaxError('expected ( as first char of string: ' + str[pos:])
+    m = _string_re.match(str, pos)
+    if not m:
+        raise SyntaxError('EOF while reading string')
+    s = m.group(1)
+    if "\\" in s:
+        s = _unescape_re.sub(r"\1", s)
+    return (s, m.end())
+
+
+def read_atom(str, pos=0):
     """Read an atom."""
-    if len(str) == 0:
+    if pos >= len(str):
         raise SyntaxError('unexpected EOF while reading atom')
-    if str[0] != '\'':
-        raise SyntaxError('expected \' as first char of atom: ' + str)
-    str = str[1:]
-    s = ""
-    while (len(str) > 0):
-        ch = str[0]
-        if ch.isspace():
-            return (s, str[1:])
-        s = s + ch
-        str = str[1:]
-    raise SyntaxError('EOF while reading atom')
-
-
-def read_keyword(str):
+    if str[pos] != '\'':
+        raise SyntaxError('expected \' as first char of atom: ' + str[pos:])
+    m = _atom_re.match(str, pos)
+    if not m:
+        raise SyntaxError('EOF while reading atom')
+    return (m.group(1), m.end())
+
+
+def read_keyword(str, pos=0):
     """Read a keyword."""
-    if len(str) == 0:
+    if pos >= len(str):
         raise SyntaxError('unexpected EOF while reading keyword')
-    if str[0] != ':':
+    if str[pos] != ':':
         raise SyntaxError('expected : as first char of keyword')
-    str = str[1:]
-    s = ""
-    while (len(str) > 0):
-        ch = str[0]
-        if not (ch.isalpha() or ch.isdigit() or ch == '-'):
-            return (Keyword(":" + s), str)
-        else:
-            s = s + ch
-            str = str[1:]
-
-    if len(s) > 1:
-        return (Keyword(":" + s), str)
-    else:
+    end = _keyword_re.match(str, pos).end()
+    if end == len(str) and end - pos <= 2:
         raise SyntaxError('EOF while reading keyword')
+    return (Keyword(str[pos:end]), end)
 
 
-def read_symbol(str):
+def read_symbol(str, pos=0):
     """Read a symbol."""
-    if len(str) == 0:
+    if pos >= len(str):
         raise SyntaxError('unexpected EOF while reading symbol')
-    if not str[0].isalpha():
+    if not str[pos].isalpha():
         raise SyntaxError('expected alpha char as first char of symbol')
-    s = ""
-    while (len(str) > 0):
-        ch = str[0]
-        if not (ch.isalpha() or ch.isdigit() or ch == '-' or ch == ":"):
-            if s == "t":
-                return (True, str)
-            elif s == "nil":
-                return (False, str)
-            else:
-                return (Symbol(s), str)
-        else:
-            s = s + ch
-            str = str[1:]
-
-    if len(s) > 0:
-        return (Symbol(s), str)
+    end = _symbol_re.match(str, pos).end()
+    s = str[pos:end]
+    if s == "t":
+        return (True, end)
+    elif s == "nil":
+        return (False, end)
     else:
-        raise SyntaxError('EOF while reading symbol')
+        return (Symbol(s), end)
 
 
-def read_int(str):
+def read_int(str, pos=0):
     """Read an integer."""
-    if len(str) == 0:
+    if pos >= len(str):
         raise SyntaxError('unexpected EOF while reading int')
-    s = ""
-    while (len(str) > 0):
-        ch = str[0]
-        if not (ch.isdigit() or ch == '-'):
-            return (int(s), str)
-        else:
-            s = s + ch
-            str = str[1:]
+    end = _int_re.match(str, pos).end()
+    return (int(str[pos:end]), end)
+
+
+_string_body_re = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+_delimiter_re = re.compile(r'[\s()"]', re.UNICODE)
+_space_re = re.compile(r"\s", re.UNICODE)
+_structure_re = re.compile(r'[()"]')
+
+
+class Deferred(object):
+    """A form that has been received, but hasn't been parsed yet.
+    The text is parsed the first time somebody asks for the value,
+    on the thread that does the asking, and the result is cached."""
+    __slots__ = ("text", "plists", "_value", "_parsed")
+
+    def __init__(self, text, plists=None):
+        self.text = text
+        self.plists = plists
+        self._value = None
+        self._parsed = False
+
+    def force(self, plists=None):
+        """Parse the form if that hasn't been done yet and return its value.
+        `plists` overrides the mode the form has been created with,
+        but only takes effect on the first call."""
+        if not self._parsed:
+            if plists is None:
+                plists = self.plists
+            value = read(self.text, plists)
+            if plists and type(value) is list:
+                value = plist_to_key_map(value) or value
+            self._value = value
+            self._parsed = True
+        return self._value
 
-    if len(s) > 0:
-        return (int(s), str)
-    else:
-        raise SyntaxError('EOF while reading int')
+    def __repr__(self):
+        # repr has to be a plain str on Python 2, or printing a form that holds non-ASCII text fails
+        if isinstance(self.text, str):
+            return self.text
+        return self.text.encode("ascii", "backslashreplace")
+
+
+def force(form, plists=None):
+    """Return the value of a form that might still be deferred."""
+    return form.force(plists) if type(form) is Deferred else form
+
+
+class Decoder(object):
+    """Push-style incremental reader.
+    Feed it chunks of bytes as they arrive from the socket,
+    and it returns the top-level forms completed by each chunk.
+    Open lists, a partially received string and an incomplete
+    multibyte character all survive chunk boundaries.
+    `plists` has the same meaning as in `read_form_iter`.
+    `defer` is called with the stack of open lists whenever a nested list starts,
+    and if it says so, the list is only scanned for its end and becomes a `Deferred`."""
+
+    def __init__(self, encoding="utf-8", plists=None, defer=None):
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._plists = plists
+        self._defer = defer
+        self._stack = []
+        self._tail = u""
+        self._pieces = None
+        self._skip_pieces = None
+        self._skip_depth = 0
+        self._skip_in_string = False
+        self._skip_plists = None
+
+    def feed(self, data):
+        """Decode a chunk of bytes and return the list of forms it has completed.
+        Besides byte strings, `data` can be a bytearray or a memoryview slice of a receive buffer,
+        which is then decoded in place."""
+        text = self._decode(data)
+        if self._tail:
+            text = self._tail + text
+            self._tail = u""
+        stack = self._stack
+        forms = []
+        pos, end = 0, len(text)
+        while True:
+            if self._skip_pieces is not None:
+                pos = self._skip(text, pos)
+                if pos is None:
+                    return forms
+                val = Deferred("".join(self._skip_pieces), self._skip_plists)
+                self._skip_pieces = None
+            elif self._pieces is not None:
+                # inside a string that has started in one of the previous chunks
+                start = pos
+                pos = _string_body_re.match(text, pos).end()
+                if pos == end or text[pos] != '"':
+                    self._pieces.append(text[start:pos])
+                    self._tail = text[pos:]  # possibly a dangling backslash
+                    return forms
+                self._pieces.append(text[start:pos])
+                val = "".join(self._pieces)
+                if "\\" in val:
+                    val = _unescape_re.sub(r"\1", val)
+                self._pieces = None
+                pos += 1
+            else:
+                pos = _whitespace_re.match(text, pos).end()
+                if pos == end:
+                    return forms
+                ch = text[pos]
+                if ch == '(':
+                    if stack and self._defer and self._defer(stack):
+                        self._skip_pieces = []
+                        self._skip_plists = _reads_plists(self._plists, stack)
+                    else:
+                        stack.append([])
+                        pos += 1
+                    continue
+                elif ch == ')' and stack:
+                    val = stack.pop()
+                    pos += 1
+                    if _reads_plists(self._plists, stack):
+                        val = plist_to_key_map(val) or val
+                elif ch == '"':
+                    self._pieces = []
+                    pos += 1
+                    continue
+                else:
+                    # other atoms are short, so if one runs into the end of the chunk
+                    # we hold on to it and read it again once more input arrives
+                    delimiter_re = _space_re if ch == '\'' else _delimiter_re
+                    if not delimiter_re.search(text, pos + 1):
+                        self._tail = text[pos:]
+                        return forms
+                    val, pos = read_form(text, pos)
+            if stack:
+                stack[-1].append(val)
+            else:
+                forms.append(val)
+
+    def _decode(self, data):
+        decoder = self._decoder
+        if isinstance(data, bytes):
+            return decoder.decode(data)
+        buffer_decode = getattr(decoder, "_buffer_decode", None)
+        if decoder.buffer or not buffer_decode:
+            # a multibyte character was cut in half by the previous chunk, we have to copy this one
+            return decoder.decode(data.tobytes() if hasattr(data, "tobytes") else bytes(data))
+        # the incremental decoder would concatenate the view with its (empty) buffer,
+        # so we call the underlying codec and keep an incomplete trailing character ourselves
+        text, consumed = buffer_decode(data, decoder.errors, False)
+        if consumed < len(data):
+            decoder.buffer = bytes(bytearray(data[consumed:]))
+        return text
+
+    def _skip(self, text, pos):
+        """Scan over a deferred list, collecting its text.
+        Returns the position right after the list, or None if the list goes on in the next chunk."""
+        pieces, end = self._skip_pieces, len(text)
+        start = pos
+        while True:
+            if self._skip_in_string:
+                pos = _string_body_re.match(text, pos).end()
+                if pos == end or text[pos] != '"':
+                    pieces.append(text[start:pos])
+                    self._tail = text[pos:]  # possibly a dangling backslash
+                    return None
+                self._skip_in_string = False
+                pos += 1
+            m = _structure_re.search(text, pos)
+            if m is None:
+                pieces.append(text[start:])
+                return None
+            pos = m.end()
+            ch = m.group()
+            if ch == '"':
+                self._skip_in_string = True
+            elif ch == '(':
+                self._skip_depth += 1
+            else:
+                self._skip_depth -= 1
+                if self._skip_depth == 0:
+                    pieces.append(text[start:pos])
+                    return pos
 
 
 def to_string(exp):
     """Convert a Python object back into a Lisp-readable string."""
-    if isinstance(exp, list):
-        return '(' + ' '.join(map(to_string, exp)) + ')'
-    else:
-        return atom_to_str(exp)
+    parts = []
+    write(exp, parts)
+    return "".join(parts)
+
+
+def to_frame(exp, encoding="utf-8"):
+    """Serialize a Python object into a ready-to-send swank frame:
+    the payload length in bytes as six hex digits, followed by the encoded payload."""
+    parts = []
+    write(exp, parts)
+    payload = u"".join(parts).encode(encoding)
+    return b"%06x" % len(payload) + payload
+
+
+def write(exp, parts):
+    """Serialize a Python object by appending pieces of its Lisp-readable representation to `parts`.
+    Nothing is concatenated along the way, so even a request that carries a whole buffer
+    is assembled in a single pass when the caller joins the pieces.
+    Like `read_form_iter`, this keeps open lists on an explicit stack rather than recursing."""
+    stack = []
+    elems, first = iter([exp]), True
+    while True:
+        for exp in elems:
+            if first:
+                first = False
+            else:
+                parts.append(" ")
+            if isinstance(exp, list):
+                parts.append("(")
+                stack.append(elems)
+                elems, first = iter(exp), True
+                break
+            elif isinstance(exp, basestring):
+                if type(exp) is str:
+                    exp = exp.decode("utf-8")
+                parts.append("\"")
+                if "\\" in exp or "\"" in exp:
+                    exp = exp.replace("\\", "\\\\").replace("\"", "\\\"")
+                parts.append(exp)
+                parts.append("\"")
+            else:
+                parts.append(atom_to_str(exp))
+        else:
+            if not stack:
+                return
+            parts.append(")")
+            elems, first = stack.pop(), False
 
 
 def atom_to_str(exp):
@@ -0,0 +1,283 @@
+"""Micro-benchmarks for the sexp reader/writer and the rpc record decoders.
+
+Runs outside of Sublime on synthetic ENSIME payloads of several sizes:
+
+    python tests/bench.py                          # print results
+    python tests/bench.py -o after.json            # also save them
+    python tests/bench.py -o after.json -c before.json  # compare with an earlier run
+"""
+from __future__ import print_function
+import sys, os, gc, time, json, platform, subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import sexp
+import rpc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# ############################# PAYLOADS ##############################
+
+def quote(s):
+    return "\"" + s.replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+
+
+def notes_payload(n):
+    note = "(:severity error :msg %s :beg %d :end %d :line %d :col %d :file %s)"
+    notes = [note % (quote("type mismatch;\n found   : Int\n required: String (#%d)" % i), i * 40, i * 40 + 12,
+                     i + 1, 5, quote("/home/user/project/src/main/scala/pkg%d/Module%d.scala" % (i % 7, i % 50)))
+             for i in range(n)]
+    return "(:scala-notes (:is-full nil :notes (" + " ".join(notes) + ")))"
+
+
+def completions_payload(n):
+    completion = "(:name %s :type-sig (((%s %s) (%s %s)) %s) :type-id %d :is-callable t :relevance %d :to-insert nil)"
+    completions = [completion % (quote("member%d" % i), quote("x"), quote("Int"), quote("y"), quote("List[String]"),
+                                 quote("Option[Map[String, Int]]"), i, 90 - i % 90)
+                   for i in range(n)]
+    return "(:return (:ok (:prefix \"mem\" :completions (" + " ".join(completions) + "))) 42)"
+
+
+def type_info(depth, members):
+    member = "(:name %s :type-id %d :full-name \"scala.Int\" :decl-as method :type-args nil :members nil)"
+    tpe = "(:name \"Int\" :type-id 1 :full-name \"scala.Int\" :decl-as class :type-args nil :members nil)"
+    for i in range(depth):
+        tpe = ("(:name \"Wrapper%d\" :type-id %d :full-name \"pkg.Wrapper%d\" :decl-as class :type-args (%s) "
+               ":pos (:file \"/src/Wrapper.scala\" :offset %d) :members nil :outer-type-id nil)") % (i, i + 2, i, tpe, i)
+    members = " ".join(member % (quote("m%d" % i), i) for i in range(members))
+    return ("(:return (:ok (:name \"Big\" :type-id 0 :full-name \"pkg.Big\" :decl-as class :type-args (%s) "
+            ":members (%s))) 7)") % (tpe, members)
+
+
+def backtrace_payload(frames, locals_per_frame):
+    local = "(:index %d :name %s :summary %s :type-name \"java.lang.String\")"
+    frame = ("(:index %d :locals (%s) :num-args 2 :class-name \"pkg.Service\" :method-name %s "
+             ":pc-location (:file \"/src/Service.scala\" :line %d) :this-object-id \"%d\")")
+    rendered = [frame % (f, " ".join(local % (l, quote("local%d" % l), quote("\"value %d\"" % l))
+                                     for l in range(locals_per_frame)),
+                         quote("method%d" % f), f + 10, 1000 + f)
+                for f in range(frames)]
+    return "(:return (:ok (:frames (" + " ".join(rendered) + ") :thread-id \"1\" :thread-name \"main\")) 9)"
+
+
+def reply_body(form):
+    return form[1][1]
+
+
+def event_body(form):
+    return form[1]
+
+
+def plists(form):
+    """Returns every plist in `form`, e.g. each note, completion or frame, and the envelopes around them."""
+    found = []
+    stack = [form]
+    while stack:
+        value = stack.pop()
+        if type(value) is list:
+            keys = value[::2]
+            if keys and len(value) % 2 == 0 and all(type(k) is sexp.Keyword for k in keys):
+                found.append(value)
+            stack.extend(value)
+    return found
+
+
+# name, payload (made on demand), how to get to the record inside the envelope, record parser
+SUITE = [
+    ("notes-100", lambda: notes_payload(100), event_body, rpc.Note.parse_list),
+    ("notes-1k", lambda: notes_payload(1000), event_body, rpc.Note.parse_list),
+    ("notes-10k", lambda: notes_payload(10000), event_body, rpc.Note.parse_list),
+    ("completions-100", lambda: completions_payload(100), reply_body, rpc.CompletionInfoList.parse),
+    ("completions-1k", lambda: completions_payload(1000), reply_body, rpc.CompletionInfoList.parse),
+    ("typeinfo-deep-50", lambda: type_info(50, 10), reply_body, rpc.TypeInfo.parse),
+    ("typeinfo-deep-200", lambda: type_info(200, 10), reply_body, rpc.TypeInfo.parse),
+    ("typeinfo-members-5k", lambda: type_info(2, 5000), reply_body, rpc.TypeInfo.parse),
+    ("backtrace-20x10", lambda: backtrace_payload(20, 10), reply_body, rpc.DebugBacktrace.parse),
+    ("backtrace-100x50", lambda: backtrace_payload(100, 50), reply_body, rpc.DebugBacktrace.parse),
+]
+
+
+# ############################# MEASUREMENTS ##############################
+
+def _proc_status_kb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def peak_rss_kb():
+    peak = _proc_status_kb("VmHWM")  # getrusage only catches up with the peak lazily on Linux
+    if peak is not None or resource is None:
+        return peak
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss  # bytes on Mac OS, kilobytes elsewhere
+
+
+def current_rss_kb():
+    rss = _proc_status_kb("VmRSS")
+    return rss if rss is not None else peak_rss_kb()  # no procfs (e.g. on Mac OS), fall back to the peak so far
+
+
+def reset_peak_rss():
+    """Brings the peak RSS down to the current RSS, where the OS allows that (Linux 4.0 and later)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def measure(fn, min_time, max_repeat=1000):
+    """Runs fn until it has taken at least min_time seconds in total, returns the best time per run."""
+    best, total, runs = None, 0.0, 0
+    while (total < min_time or runs < 3) and runs < max_repeat:
+        gc.collect()
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+        total += elapsed
+        runs += 1
+    return best, runs
+
+
+def make_cases(text, body, parser):
+    """Returns (op, setup) pairs, where `setup()` prepares what the op needs and returns the op itself,
+    so that a case measured on its own doesn't pay for the setup of the others."""
+    data = text.encode("utf-8")
+
+    def with_form(op):
+        def setup():
+            form = sexp.read(text)
+            return lambda: op(form)
+        return setup
+
+    def convert_plists():
+        records = plists(body(sexp.read(text)))
+        return lambda: [sexp.sexp_to_key_map(record) for record in records]
+
+    return [
+        ("sexp.read", lambda: lambda: sexp.read(text)),
+        ("sexp.read_form", lambda: lambda: sexp.read_form(text)),  # the recursive reader, for comparison
+        ("sexp.Decoder", lambda: lambda: sexp.Decoder().feed(data)),
+        ("sexp.Decoder(defer)", lambda: lambda: sexp.Decoder(defer=lambda stack: len(stack) == 1).feed(data)),
+        ("sexp.to_string", with_form(lambda form: sexp.to_string([sexp.key(":swank-rpc"), form, 1]))),
+        ("sexp.to_frame", with_form(lambda form: sexp.to_frame([sexp.key(":swank-rpc"), form, 1]))),
+        ("sexp_to_key_map", convert_plists),  # of all the plists in the payload, not just the outermost one
+        (parser.__self__.__name__ + ".parse", with_form(lambda form: parser(body(form)))),
+    ]
+
+
+def measure_rss(case):
+    """Runs a single "payload:op" case in this process, and prints how far above the memory in use beforehand
+    the peak RSS has gone. The peak RSS only ever grows, so every case is measured in a fresh process
+    (see `peak_rss_delta_kb`), where earlier cases can't have pushed it up already.
+    Where the peak can't be reset, an op that stays below the peak reached by its own setup
+    can't be measured, and "-" is printed."""
+    name, op = case.split(":", 1)
+    for payload, make_payload, body, parser in SUITE:
+        if payload == name:
+            fn = dict(make_cases(make_payload(), body, parser))[op]()
+            gc.collect()
+            reset = reset_peak_rss()
+            peak_before = peak_rss_kb()
+            before = current_rss_kb()
+            fn()
+            peak_after = peak_rss_kb()
+            print(peak_after - before if reset or peak_after > peak_before else "-")
+            return
+
+
+def peak_rss_delta_kb(name, op):
+    if peak_rss_kb() is None:
+        return None
+    output = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--rss", name + ":" + op],
+                              stdout=subprocess.PIPE).communicate()[0]
+    try:
+        return int(output.strip())
+    except ValueError:
+        return None
+
+
+def run_suite(min_time):
+    results = []
+    for name, make_payload, body, parser in SUITE:
+        text = make_payload()
+        size = len(text.encode("utf-8"))
+        for op, setup in make_cases(text, body, parser):
+            seconds, runs = measure(setup(), min_time)
+            results.append({
+                "payload": name,
+                "op": op,
+                "bytes": size,
+                "runs": runs,
+                "seconds": seconds,
+                "mb_per_s": size / seconds / 2 ** 20 if seconds else None,
+                "msgs_per_s": 1.0 / seconds if seconds else None,
+                "peak_rss_delta_kb": peak_rss_delta_kb(name, op),
+            })
+            print("%-20s %-22s %9d B %10.3f ms %9.2f MB/s %9s KB" % (
+                name, op, size, seconds * 1000, results[-1]["mb_per_s"] or 0, results[-1]["peak_rss_delta_kb"]))
+    return results
+
+
+def git_revision():
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], cwd=cwd,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip().decode()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    before = dict(((r["payload"], r["op"]), r["seconds"]) for r in baseline["results"])
+    print("\ncompared to %s (revision %s):" % (baseline_file, baseline.get("revision")))
+    for r in results:
+        old = before.get((r["payload"], r["op"]))
+        if old:
+            print("%-20s %-22s %6.2fx %s" % (r["payload"], r["op"], old / r["seconds"],
+                                             "faster" if old >= r["seconds"] else "SLOWER"))
+
+
+def main():
+    parser = OptionParser(usage="%prog [-o results.json] [-c baseline.json]")
+    parser.add_option("-o", "--output", help="write results to this JSON file")
+    parser.add_option("-c", "--compare", help="compare results with an earlier JSON file")
+    parser.add_option("-t", "--min-time", type="float", default=0.2,
+                      help="minimum time to spend on each measurement, in seconds")
+    parser.add_option("--rss", help=SUPPRESS_HELP)  # used internally, see `peak_rss_delta_kb`
+    options, _ = parser.parse_args()
+    if options.rss:
+        measure_rss(options.rss)
+        return
+
+    results = run_suite(options.min_time)
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
-import sublime, sys
+import sublime, sys, time, os, tempfile, shutil
 from unittest import TestCase
 import sexp
 import rpc
+import ioloop
+import metrics
+import ui
+import logger
+import dotsession
 from rpc import *
 
 version = sublime.version()
@@ -19,6 +24,121 @@ else:
    ensime =  sys.modules["Ensime.ensime"]
 
 
+class FakeClient(object):
+	"""Answers nothing: requests are recorded with their futures, which tests resolve as they see fit."""
+	def __init__(self):
+		self.timeout = 1
+		self.sent = []
+		self.in_background = []
+
+	def request(self, to_send, parser=None, timeout=None, background=False, deadline=None):
+		future = RpcFuture(parser)
+		self.sent.append((to_send, future))
+		if background:
+			self.in_background.append(future)
+		return future
+
+	def batch_request(self, requests, timeout=None, deadline=None):
+		return [self.request(to_send, parser) for to_send, parser in requests]
+
+	def log_client(self, data, *args, **kwargs):
+		pass
+
+
+class FakeController(object):
+	def __init__(self):
+		self.client = FakeClient()
+		self.shutdowns = 0
+
+	def shutdown(self):
+		self.shutdowns += 1
+
+
+class FakeEnv(object):
+	def __init__(self):
+		import threading
+		self.settings = {}
+		self.session_id = 1
+		self.controller = FakeController()
+		self.rpc_latest = {}
+		self.rpc_in_flight = {}
+		self.rpc_lock = threading.RLock()
+		self.rpc_cache = ResponseCache(8)
+		self.breakpoints = []
+		self.log_root = tempfile.gettempdir()
+
+	@property
+	def rpc(self):
+		return Rpc(self)
+
+
+class FakeSocket(object):
+	def __init__(self):
+		self.connected = True
+		self.sent = []
+
+	def send(self, frame, block=True):
+		self.sent.append(frame)
+		return self.connected
+
+	def close(self):
+		self.connected = False
+
+
+def drain_ui():
+	"""Runs the UI work that's pending, including the work it submits in turn."""
+	while ui.instance()._queue:
+		ui.instance()._drain()
+
+
+def fake_command(cls, env, view=None):
+	"""An instance of `cls` bound to `env` and `view`, whose status messages are collected in `messages`."""
+	command = cls.__new__(cls)
+	command._env = env
+	command.v = view
+	command.messages = []
+	command.status_message = command.messages.append
+	return command
+
+
+def fake_client(env):
+	"""A client of `env` that sends its requests to a `FakeSocket`."""
+	fd, port_file = tempfile.mkstemp()
+	os.write(fd, b"0")
+	os.close(fd)
+	for_window = ensime.env.for_window
+	ensime.env.for_window = lambda window: env
+	try:
+		client = ensime.Client(sublime.active_window(), port_file, 1)
+	finally:
+		ensime.env.for_window = for_window
+		os.remove(port_file)
+	client.socket = FakeSocket()
+	env.controller.client = client
+	return client
+
+
+class Unprintable(object):
+	def __unicode__(self):
+		raise ValueError("no text")
+
+
+class FakeView(object):
+	def __init__(self, view_id):
+		self.view_id = view_id
+		self.changes = 0
+		self.commands = []
+
+	def id(self):
+		return self.view_id
+
+	def change_count(self):
+		return self.changes
+
+	def run_command(self, command, args=None):
+		self.commands.append(command)
+
+
 class test_internal_functions(TestCase):
 
 	def checkDecode(self, swankStr, parseFn):
@@ -33,3 +153,429 @@ class test_internal_functions(TestCase):
 
 		self.checkDecode("""(:prefix "fooBar" :completions ((:name "name" :type-sig (((("abc" "def") ("hij" "lmn"))) "ABC") :type-id 88 :is-callable nil :relevance 90 :to-insert "BAZ")))""",
 			CompletionInfoList.parse)
+
+	def test_read_atoms(self):
+		form = sexp.read("""(:msg "say \\"hi\\" to C:\\\\tmp" :line 12 :offset -3 :ok t :failed nil :decl-as method :args ())""")
+		m = sexp.sexp_to_key_map(form)
+		self.assertEqual(m[":msg"], "say \"hi\" to C:\\tmp")
+		self.assertEqual(m[":line"], 12)
+		self.assertEqual(m[":offset"], -3)
+		self.assertEqual(m[":ok"], True)
+		self.assertEqual(m[":failed"], False)
+		self.assertEqual(m[":decl-as"], sexp.sym("method"))
+		self.assertEqual(m[":args"], [])
+
+	def test_read_deeply_nested(self):
+		depth = 10000
+		form = sexp.read("(" * depth + "42" + ")" * depth)
+		for _ in range(depth):
+			self.assertEqual(len(form), 1)
+			form = form[0]
+		self.assertEqual(form, 42)
+
+	def test_iterative_reader_matches_recursive(self):
+		note = """(:severity error :msg "type mismatch" :beg %d :end %d :line 7 :col 3 :file "/src/Foo.scala")"""
+		swankStr = "(:is-full nil :notes (" + " ".join(note % (i, i + 5) for i in range(2000)) + "))"
+		self.assertEqual(sexp.read_form(swankStr)[0], sexp.read_form_iter(swankStr)[0])
+
+	def test_decoder_across_chunks(self):
+		reply = u"""(:return (:ok (:name "caf\u00e9 \\"bar\\"" :type-id 7 :decl-as method)) 3)"""
+		event = u"""(:compiler-ready t)"""
+		data = (reply + event).encode("utf-8")
+		for size in range(1, len(data) + 1):
+			decoder = sexp.Decoder()
+			forms = []
+			for i in range(0, len(data), size):
+				forms.extend(decoder.feed(data[i:i + size]))
+			self.assertEqual(forms, [sexp.read(reply), sexp.read(event)])
+
+	def test_decoder_over_buffer_views(self):
+		reply = u"""(:return (:ok (:name "caf\u00e9 \\"bar\\"" :type-id 7 :decl-as method)) 3)"""
+		buf = bytearray(reply.encode("utf-8"))
+		views = [buf]
+		if sys.version_info >= (2, 7):
+			views.append(memoryview(buf))
+		for view in views:
+			for size in range(1, len(buf) + 1):
+				decoder = sexp.Decoder()
+				forms = []
+				for i in range(0, len(buf), size):
+					forms.extend(decoder.feed(view[i:i + size]))
+				self.assertEqual(forms, [sexp.read(reply)])
+
+	def test_client_socket_reassembles_split_headers(self):
+		received = []
+
+		class Listener(object):
+			def on_client_async_data(self, data):
+				received.append(data)
+
+		class ChunkedSocket(object):
+			def __init__(self, chunks):
+				self.chunks = chunks
+
+			def recv_into(self, buf):
+				chunk = self.chunks.pop(0)
+				buf[:len(chunk)] = chunk
+				return len(chunk)
+
+		first = sexp.to_frame(sexp.read("(:compiler-ready t)"))
+		second = sexp.to_frame(sexp.read("""(:background-message 105 "Initializing")"""))
+		data = first + second
+		client_socket = ensime.ClientSocket.__new__(ensime.ClientSocket)
+		client_socket.handlers = [Listener()]
+		client_socket.metrics = metrics.Registry()
+		client_socket._reset_receiver()
+		# the header of the second message is split between two reads
+		client_socket.socket = ChunkedSocket([data[:len(first) + 3], data[len(first) + 3:]])
+		client_socket._receive()
+		self.assertEqual(len(received), 1)
+		client_socket._receive()
+		self.assertEqual([form[0] for form in received], [sexp.key(":compiler-ready"), sexp.key(":background-message")])
+		self.assertEqual(received[1][2], "Initializing")
+
+	def test_atoms_are_interned(self):
+		form = sexp.read("(:file \"A.scala\" :decl-as method :file \"B.scala\" :decl-as method)")
+		self.assertTrue(form[0] is form[4] is sexp.key(":file"))
+		self.assertTrue(form[3] is form[7] is sexp.sym("method"))
+		self.assertNotEqual(sexp.key(":file"), sexp.sym(":file"))
+		self.assertEqual({sexp.key(":file"): 1}[form[0]], 1)
+
+	def test_read_plists_as_dicts(self):
+		swankStr = """(:scala-notes (:is-full nil :notes ((:severity error :msg "oops" :beg 1 :end 5 :line 2 :col 3 :file "A.scala"))))"""
+		form = sexp.read(swankStr, plists=[sexp.key(":scala-notes")])
+		self.assertEqual(form[0], sexp.key(":scala-notes"))
+		notes = Note.parse_list(form[1])
+		self.assertEqual(len(notes), 1)
+		self.assertEqual(notes[0].message, "oops")
+		self.assertEqual(notes[0].col, 3)
+		untouched = sexp.read(swankStr, plists=[sexp.key(":return")])
+		self.assertEqual(type(untouched[1]), list)
+
+	def test_frame_counts_bytes(self):
+		req = [sexp.key(":swank-rpc"), [sexp.sym("swank:typecheck-file"), [sexp.key(":file"), u"/src/Caf\u00e9.scala", sexp.key(":contents"), u"val s = \"\u00e9\\\\\""]], 7]
+		frame = sexp.to_frame(req)
+		payload = frame[6:]
+		self.assertEqual(int(frame[:6], 16), len(payload))
+		self.assertEqual(payload.decode("utf-8"), sexp.to_string(req))
+		self.assertEqual(sexp.read(payload.decode("utf-8")), req)
+
+	def test_deferred_payload(self):
+		swankStr = """(:return (:ok (:name "type1" :type-id 7 :full-name "FOO.type1" :type-args ((:name "Int" :type-id 2)))) 5)"""
+		decoder = sexp.Decoder(defer=lambda stack: len(stack) == 2)
+		form = decoder.feed(swankStr.encode("utf-8"))[0]
+		self.assertEqual(form[0], sexp.key(":return"))
+		self.assertEqual(form[2], 5)
+		payload = form[1][1]
+		self.assertEqual(type(payload), sexp.Deferred)
+		tpe = TypeInfo.parse(payload)
+		self.assertEqual(tpe.full_name, "FOO.type1")
+		self.assertEqual(tpe.type_args[0].name, "Int")
+
+	def test_deferred_payload_prints_non_ascii(self):
+		swankStr = u"""(:scala-notes (:notes ((:msg "A \u21d2 B"))))"""
+		form = sexp.Decoder(defer=lambda stack: len(stack) == 1).feed(swankStr.encode("utf-8"))[0]
+		self.assertEqual(type(form[1]), sexp.Deferred)
+		self.assertTrue("A \\u21d2 B" in str(form))
+		self.assertTrue("A \\u21d2 B" in unicode(form))
+
+	def test_record_fields(self):
+		frame = DebugStackFrame.parse(sexp.read("""(:index 0 :unknown-key (1 2 3) :num-args 1 :class-name "Foo" :method-name "bar" :pc-location (:file "Foo.scala" :line 12) :this-object-id "7")"""))
+		self.assertEqual(frame.class_name, "Foo")
+		self.assertEqual(frame.pc_location.line, 12)
+		self.assertEqual(frame.locals, [])
+		other = DebugStackFrame.parse(sexp.read("""(:index 1 :num-args 0 :class-name "Foo" :method-name "baz" :pc-location (:file "Foo.scala" :line 20) :this-object-id "7")"""))
+		self.assertFalse(frame.locals is other.locals)
+		self.assertRaises(KeyError, DebugStackFrame.parse, sexp.read("""(:index 0)"""))
+
+	def test_record_with_a_fields_attribute(self):
+		value = DebugValue.parse(sexp.read("""(:val-type obj :type-name "Foo" :object-id "7" :fields ((:index 0 :name "x" :summary "1" :type-name "Int")))"""))
+		self.assertEqual([field.name for field in value.fields], ["x"])
+		self.assertTrue(isinstance(DebugValue.field_spec[0], Field))  # the spec isn't shadowed by the attribute
+		self.assertEqual(DebugValue.parse(sexp.read("""(:val-type obj :type-name "Foo")""")).fields, [])
+
+	def test_compact_notes(self):
+		note = """(:severity error :msg "%s" :beg 1 :end 2 :line 3 :col 4 :file "/src/Foo.scala")"""
+		notes = Note.parse_list(sexp.read("(:is-full nil :notes (" + note % "a" + " " + note % "b" + "))"))
+		self.assertFalse(hasattr(notes[0], "__dict__"))
+		self.assertTrue(notes[0].file_name is notes[1].file_name)
+		self.assertEqual((notes[1].message, notes[1].col), ("b", 4))
+
+	def test_rpc_futures(self):
+		results = []
+		future = RpcFuture(SourcePosition.parse)
+		chained = future.then(lambda pos: pos.offset + 1, on_ui_thread=False)
+		chained.add_done_callback(results.append, on_ui_thread=False)
+		future.set_payload(sexp.read("""(:file "Foo.scala" :offset 12)"""))
+		self.assertEqual(future.result(0).file_name, "Foo.scala")
+		self.assertEqual(results, [13])
+
+		failed = RpcFuture()
+		skipped = failed.then(results.append, on_ui_thread=False)
+		failed.set_failed()
+		self.assertTrue(skipped.failed)
+		self.assertEqual(skipped.result(0), None)
+		self.assertEqual(results, [13])
+
+		cancelled = []
+		pending = RpcFuture()
+		pending.on_cancel = lambda: cancelled.append(True)
+		combined = gather([RpcFuture(), pending])
+		self.assertEqual(combined.result(0), None)
+		self.assertTrue(combined.cancel())
+		self.assertEqual(cancelled, [True])
+		pending.set_result(1)
+		self.assertEqual(pending.result(0), None)
+
+	def test_rpc_futures_parse_where_the_result_is_used(self):
+		parsed = []
+		threads = []
+		import threading
+
+		def parser(payload):
+			parsed.append(payload)
+			threads.append(threading.currentThread())
+			return payload + 1
+
+		future = RpcFuture(parser)
+		hooked = []
+		future.add_done_hook(hooked.append)
+		results = []
+		future.add_done_callback(results.append)  # on the UI thread
+		inner = RpcFuture(parser)
+		chained = RpcFuture().then(lambda _: inner, on_ui_thread=False)
+		chained.on_cancel()  # nothing to cancel yet, but it mustn't break
+		resolver = threading.Thread(target=lambda: (future.set_payload(1), inner.set_payload(10)))
+		resolver.start()
+		resolver.join()
+		self.assertEqual(hooked, [future])
+		self.assertEqual(parsed, [])  # neither the hook nor the resolving thread parses the reply
+		ui.instance()._drain()
+		self.assertEqual(results, [2])
+		self.assertEqual(threads, [threading.currentThread()])
+		self.assertEqual(future.result(0), 2)
+		self.assertEqual(parsed, [1])
+
+		source = RpcFuture()
+		chained = source.then(lambda _: inner, on_ui_thread=False)
+		source.set_result(None)
+		self.assertEqual(chained.result(0), 11)
+
+	def test_breakpoints_are_synced_in_the_background(self):
+		env = FakeEnv()
+		client = env.controller.client
+		synced = Rpc(env).debug_set_break("Foo.scala", 12, background=True)
+		Rpc(env).debug_start(dotsession.Launch("run", "Main", "", ""), [dotsession.Breakpoint("Foo.scala", 12)])
+		self.assertEqual(client.in_background, [synced])  # launching the debugger isn't held back
+
+	def test_debug_start_without_breakpoints(self):
+		env = FakeEnv()
+		sent = env.controller.client.sent
+		launch = dotsession.Launch("run", "Main", "", "")
+		started = Rpc(env).debug_start(launch, [])
+		sent[0][1].set_payload(sexp.read("t"))  # debug-clear-all-breaks
+		drain_ui()  # sets no breakpoints, and launches the debugger anyway
+		self.assertEqual([str(to_send[0]) for to_send, _ in sent], ["swank:debug-clear-all-breaks", "swank:debug-start"])
+		sent[1][1].set_payload(sexp.read("""(:status "success")"""))
+		ui.instance()._drain()
+		self.assertTrue(started.result(0))
+
+	def test_rpc_supersedes_requests_per_view(self):
+		env = FakeEnv()
+		a, b = FakeView(1), FakeView(2)
+		first = Rpc(env).completions("Foo.scala", 12, 10, False, False, view=a)
+		other = Rpc(env).completions("Foo.scala", 12, 10, False, False, view=b)
+		second = Rpc(env).completions("Foo.scala", 13, 10, False, False, view=a)
+		self.assertTrue(first.cancelled)
+		self.assertFalse(other.done())
+		first.set_payload(sexp.read("nil"))  # a late reply is dropped
+		self.assertEqual(first.result(0), None)
+		second.set_payload(sexp.read("""(:prefix "f" :completions nil)"""))
+		other.cancel()
+		self.assertEqual(env.rpc_latest, {})  # finished requests don't linger
+
+	def test_failed_debugger_launch_is_reported(self):
+		env = FakeEnv()
+		debugger = fake_command(ensime.Debugger, env)
+		load_launch = ensime.dotsession.load_launch
+		ensime.dotsession.load_launch = lambda env: dotsession.Launch("run", "Main", "", "")
+		try:
+			debugger.start()
+		finally:
+			ensime.dotsession.load_launch = load_launch
+		env.controller.client.sent[0][1].set_failed()  # debug-clear-all-breaks
+		drain_ui()
+		self.assertEqual(debugger.messages, ["Starting the debugger...", "Debugger has failed to start run"])
+
+	def test_failed_import_suggestions_are_reported(self):
+		command = fake_command(ensime.EnsimeAddImport, FakeEnv(), FakeView(1))
+		command.handle_sugestions_response(None)
+		self.assertEqual(command.messages, ["Cannot find import suggestions"])
+
+	def test_failed_import_refactoring_is_reported(self):
+		view = FakeView(1)
+		command = fake_command(ensime.EnsimeAddImport, FakeEnv(), view)
+		command.handle_refactor_response(None)
+		self.assertEqual(command.messages, ["Cannot add the import"])
+		self.assertEqual(view.commands, [])  # the view isn't reverted
+
+	def test_rpc_coalesces_requests_per_view(self):
+		env = FakeEnv()
+		sent = env.controller.client.sent
+		a, b = FakeView(1), FakeView(2)
+		first = Rpc(env).type_at_point("Foo.scala", 12, view=a)
+		self.assertTrue(Rpc(env).type_at_point("Foo.scala", 12, view=a) is first)
+		other = Rpc(env).type_at_point("Foo.scala", 12, view=b)
+		self.assertFalse(other is first)
+		self.assertEqual(len(sent), 2)
+		Rpc(env).type_at_point("Foo.scala", 13, view=a)  # supersedes the first request of `a` only
+		self.assertTrue(first.cancelled)
+		self.assertFalse(other.done())
+		self.assertEqual(len(env.rpc_in_flight), 2)
+
+	def test_client_holds_back_background_requests(self):
+		client = fake_client(FakeEnv())
+		client.max_background_requests = 1
+		client.request_deadline = 5
+		sent = client.socket.sent
+		typecheck = sexp.read("""(swank:typecheck-file "A.scala")""")
+		first, second, third = [client.request(typecheck, background=True) for _ in range(3)]
+		self.assertEqual(len(sent), 1)
+		self.assertEqual(len(client._background_queue), 2)
+		client.request(sexp.read("(swank:connection-info)"))  # interactive requests aren't held back
+		self.assertEqual(len(sent), 2)
+		_, expires, sent_at, _ = client.continuations[1]
+		self.assertEqual(expires - sent_at, 5)
+		first.set_payload(sexp.read("t"))
+		self.assertEqual(len(sent), 3)  # the next one takes the free slot
+		client.socket.connected = False
+		second.set_payload(sexp.read("t"))
+		self.assertTrue(third.failed)  # rather than reconnecting on whatever thread the reply came in
+		self.assertEqual(len(sent), 3)
+		self.assertEqual((client._background_outstanding, client._background_queue), (0, []))
+
+	def test_client_fails_pending_requests_on_shutdown(self):
+		client = fake_client(FakeEnv())
+		client.max_background_requests = 1
+		typecheck = sexp.read("""(swank:typecheck-file "A.scala")""")
+		futures = [client.request(typecheck, background=True) for _ in range(2)]
+		futures.append(client.request(sexp.read("(swank:connection-info)")).then(lambda _: None, on_ui_thread=False))
+		results = []
+		for future in futures:
+			future.add_done_callback(results.append, on_ui_thread=False)
+		client.socket.connected = False  # e.g. the server has died
+		client.shutdown()
+		self.assertEqual(results, [None, None, None])
+		self.assertTrue(all(future.failed for future in futures))
+		self.assertEqual((client.continuations, client._background_queue, client._background_outstanding), ({}, [], 0))
+
+	def test_client_shuts_down_on_the_ui_thread_when_startup_fails(self):
+		env = FakeEnv()
+		client = fake_client(env)
+		initialized = client.request(sexp.read("(swank:init-project)"))
+		client.message_return(1, sexp.read("""(:abort 210 "Error occurred in Analyzer")"""))
+		self.assertTrue(initialized.failed)
+		self.assertEqual(env.controller.shutdowns, 0)  # not on the I/O thread, which replies arrive on
+		drain_ui()
+		self.assertEqual(env.controller.shutdowns, 1)
+
+	def test_client_sweeps_expired_requests(self):
+		client = fake_client(FakeEnv())
+		client.sweep_interval = 60
+		now = time.time()
+		expired, pending, leaked = RpcFuture(), RpcFuture(), RpcFuture()
+		leaked.set_result(None)  # e.g. superseded, and the reply never came
+		client.continuations = {1: (expired, now - 1, now - 2, "a"), 2: (pending, now + 60, now, "b"),
+								3: (leaked, now + 60, now, "c")}
+		client._sweep()
+		self.assertTrue(expired.failed)
+		self.assertFalse(pending.done())
+		self.assertEqual(list(client.continuations), [2])
+		self.assertEqual((client.timed_out_count, client.leaked_count), (1, 1))
+		client.socket = None  # stops the sweep
+
+	def test_logger_rotates_files(self):
+		for max_files, expected in [(3, ["client.log", "client.log.1", "client.log.2"]), (1, ["client.log"])]:
+			log_root = tempfile.mkdtemp()
+			try:
+				log = logger.Logger()
+				log.update({"log_to_file": ["client"], "log_max_size": 200, "log_max_files": max_files}, log_root)
+				for i in range(50):
+					log.log("client", "line %s", (i,))
+				log.flush()
+				self.assertEqual(sorted(os.listdir(log_root)), expected)
+				for name in expected:
+					self.assertTrue(os.path.getsize(os.path.join(log_root, name)) < 200 + 50)  # one line over at most
+				with open(os.path.join(log_root, "client.log")) as f:
+					self.assertTrue(f.read().splitlines()[-1].endswith("line 49"))
+			finally:
+				shutil.rmtree(log_root, True)  # the logger keeps its files open
+
+	def test_logger_survives_broken_lines(self):
+		log_root = tempfile.mkdtemp()
+		try:
+			log = logger.Logger()
+			log.update({"log_to_file": ["client"]}, log_root)
+			log.log("client", "broken: %s", (Unprintable(),))
+			log.log("client", "fine: %s", (1,))
+			log.flush()
+			with open(os.path.join(log_root, "client.log")) as f:
+				lines = f.read().splitlines()
+			self.assertEqual(len(lines), 2)
+			self.assertTrue("failed to render a log line (ValueError: no text)" in lines[0])
+			self.assertTrue(lines[1].endswith("fine: 1"))
+		finally:
+			shutil.rmtree(log_root, True)  # the logger keeps its files open
+
+	def test_response_cache(self):
+		cache = ResponseCache(2)
+		cache.put((1, 10, "a"), "A")
+		cache.put((1, 10, "b"), "B")
+		self.assertEqual(cache.get((1, 10, "a")), "A")
+		cache.put((2, 5, "c"), "C")  # evicts the least recently used entry
+		self.assertEqual(cache.get((1, 10, "b")), None)
+		self.assertEqual(cache.get((1, 10, "a")), "A")
+		cache.put((1, 11, "a"), "A2")  # the view has changed, so its old entries go away
+		self.assertEqual(cache.get((1, 10, "a")), None)
+		self.assertEqual(cache.get((2, 5, "c")), "C")
+		self.assertEqual((cache.hits, cache.misses), (3, 2))
+		cache.clear()
+		self.assertEqual(len(cache), 0)
+
+	def test_ioloop_timers(self):
+		fired = []
+		loop = ioloop.instance()
+		loop.call_later(0.05, lambda: fired.append("late"))
+		loop.call_later(0, lambda: fired.append("early"))
+		time.sleep(0.3)
+		self.assertEqual(fired, ["early", "late"])
+
+	def test_metrics(self):
+		histogram = metrics.Histogram(size=100)
+		for i in range(1, 201):
+			histogram.add(i / 1000.0)
+		self.assertEqual(histogram.count, 200)
+		self.assertEqual(histogram.percentiles(50, 99), [0.151, 0.2])
+		self.assertEqual(histogram.max(), 0.2)
+		rate = metrics.Rate(window=10)
+		rate.add(5, now=100.5)
+		rate.add(15, now=101.2)
+		self.assertEqual(rate.per_second(now=102), 2.0)
+		self.assertEqual(rate.per_second(now=120), 0.0)
+		registry = metrics.Registry()
+		registry.record_latency("swank:type-at-point", 0.02)
+		parse = registry.timed("swank:type-at-point", lambda payload: payload + 1)
+		self.assertEqual(parse(1), 2)
+		self.assertTrue("swank:type-at-point" in registry.render({"swank:typecheck-file": 1}))
+
+	def test_ui_dispatcher_merges_keyed_work(self):
+		ran = []
+		dispatcher = ui.Dispatcher()
+		dispatcher.submit(("redraw", 1), ran.append, ("stale redraw",))
+		dispatcher.submit(None, ran.append, ("reply",))
+		dispatcher.submit(("redraw", 2), ran.append, ("other view",))
+		dispatcher.submit(("redraw", 1), ran.append, ("redraw",))
+		dispatcher._drain()
+		self.assertEqual(ran, ["redraw", "reply", "other view"])
+		dispatcher._drain()
+		self.assertEqual(len(ran), 3)
@@ -0,0 +1,99 @@
+import threading, traceback
+import sublime
+
+# work for the UI thread (replies, notes, status updates, redraws) piles up in one queue,
+# and the whole queue is run in a single set_timeout tick, instead of every piece scheduling a tick of its own.
+# work submitted under a key replaces the work pending under the same key,
+# so that a burst of e.g. redraws of the same view only redraws it once
+
+dispatcherLock = threading.RLock()
+_dispatcher = None
+
+
+def instance():
+    global _dispatcher
+    dispatcherLock.acquire()
+    try:
+        if not _dispatcher:
+            _dispatcher = Dispatcher()
+        return _dispatcher
+    finally:
+        dispatcherLock.release()
+
+
+def call(fn, *args):
+    """Runs `fn(*args)` on the UI thread, in the order of submission. Can be called from any thread."""
+    instance().submit(None, fn, args)
+
+
+def call_once(key, fn, *args, **kwargs):
+    """Like `call`, but if work is already pending under `key`, it's replaced with `fn(*args)` rather than
+    queued twice. With `delay` (in milliseconds), the work waits for that long, and everything submitted
+    under `key` in the meanwhile is merged into the last submission."""
+    delay = kwargs.get("delay", 0)
+    if delay:
+        instance().submit_later(key, fn, args, delay)
+    else:
+        instance().submit(key, fn, args)
+
+
+class Dispatcher(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = []  # [key, fn, args] entries
+        self._keyed = {}  # key -> entry in the queue
+        self._delayed = {}  # key -> (fn, args)
+        self._scheduled = False
+
+    def submit(self, key, fn, args):
+        self._lock.acquire()
+        try:
+            entry = self._keyed.get(key) if key is not None else None
+            if entry:
+                entry[1], entry[2] = fn, args
+                return
+            entry = [key, fn, args]
+            self._queue.append(entry)
+            if key is not None:
+                self._keyed[key] = entry
+            schedule = not self._scheduled
+            self._scheduled = True
+        finally:
+            self._lock.release()
+        if schedule:
+            sublime.set_timeout(self._drain, 0)
+
+    def submit_later(self, key, fn, args, delay):
+        self._lock.acquire()
+        try:
+            schedule = key not in self._delayed
+            self._delayed[key] = (fn, args)
+        finally:
+            self._lock.release()
+        if schedule:
+            sublime.set_timeout(lambda: self._fire(key), delay)
+
+    def _fire(self, key):
+        self._lock.acquire()
+        try:
+            fn, args = self._delayed.pop(key)
+        finally:
+            self._lock.release()
+        self._run(fn, args)
+
+    def _drain(self):
+        self._lock.acquire()
+        try:
+            queue, self._queue, self._keyed = self._queue, [], {}
+            self._scheduled = False
+        finally:
+            self._lock.release()
+        # whatever gets submitted while draining runs in the next tick
+        for _, fn, args in queue:
+            self._run(fn, args)
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            traceback.print_exc()